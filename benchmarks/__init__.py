@@ -0,0 +1,217 @@
+"""
+Rucola benchmarks
+
+Generates synthetic source trees and measures how long the main
+:any:`rucola.Rucola` operations take. Results are saved as JSON files,
+so they can be compared between commits:
+
+    $ python -m benchmarks --files 20000 --save before.json
+    $ git checkout my-branch
+    $ python -m benchmarks --files 20000 --compare before.json
+
+Comparing fails (exit code 1) when some benchmark is slower than
+a `--threshold` allows.
+
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import tempfile
+
+import rucola
+
+
+TEXT_EXTENSIONS = ('.md', '.html', '.txt', '.css')
+BINARY_EXTENSIONS = ('.jpg', '.png', '.woff')
+WORDS = ('rucola', 'banana', 'apple', 'static', 'site', 'page', 'post',
+         'layout', 'markdown', 'template', 'lorem', 'ipsum')
+
+
+# Synthetic sites
+
+def generate_site(path, files=1000, depth=3, fanout=4, min_size=256,
+                  max_size=64 * 1024, binary=0.2, seed=0):
+    """Creates a `src` directory with a synthetic site in `path`.
+    Returns list of created paths, relative to the `src` directory.
+
+        `files`
+            Number of files.
+
+        `depth`, `fanout`
+            Files are put in directories nested up to `depth` levels,
+            each directory has up to `fanout` subdirectories.
+
+        `min_size`, `max_size`
+            File sizes are log-uniformly distributed in this range, so
+            there are many small files and a few big ones.
+
+        `binary`
+            Fraction of binary files, filled with random bytes.
+
+        `seed`
+            Random seed, same arguments always give the same site.
+
+    """
+
+    rand = random.Random(seed)
+    source = os.path.join(path, rucola.SOURCE_DIR)
+    created = []
+
+    low, high = math.log(min_size), math.log(max_size)
+
+    for i in range(files):
+
+        dirs = ['d{}'.format(rand.randrange(fanout))
+                for j in range(rand.randint(0, depth))]
+        size = int(round(math.exp(rand.uniform(low, high))))
+        size = min(max_size, max(min_size, size))
+
+        if rand.random() < binary:
+            name = 'file{}{}'.format(i, rand.choice(BINARY_EXTENSIONS))
+            data = bytes(rand.getrandbits(8) for j in range(min(size, 4096)))
+            data = (data * (size // len(data) + 1))[:size]
+        else:
+            name = 'file{}{}'.format(i, rand.choice(TEXT_EXTENSIONS))
+            text = []
+            length = 0
+            while length < size:
+                text.append(rand.choice(WORDS))
+                length += len(text[-1]) + 1
+            data = ' '.join(text).encode('utf-8')[:size]
+
+        relpath = '/'.join(dirs + [name])
+        fullpath = os.path.join(source, *relpath.split('/'))
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        with open(fullpath, 'wb') as f:
+            f.write(data)
+        created.append(relpath)
+
+    return created
+
+
+# Dummy plugins
+
+def touch_paths(app):
+    """Reads a path of every file."""
+    for f in app.files:
+        f.path
+
+def read_some(app):
+    """Reads a content of every tenth text file."""
+    for f in app.find('**/*.md')[::10]:
+        f.content
+
+def rename_pages(app):
+    """Changes extension of all markdown files."""
+    for f in app.find('**/*.md'):
+        f.path = f.path[:-3] + '.html'
+
+
+# Benchmarks
+
+def measure(func, repeat=3, setup=None):
+    """Returns the best time of `repeat` calls of `func`, in seconds.
+    If there is a `setup` function, it is called before each call and
+    not timed, `func` gets its result as an argument."""
+
+    best = None
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        t = time.perf_counter() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def run(path, paths, repeat=3, jobs=4):
+    """Runs all benchmarks on a site generated in `path`, `paths` is a list
+    returned by :any:`generate_site()`. Returns dict: name => seconds."""
+
+    results = {}
+    sample = random.Random(0).sample(paths, min(1000, len(paths)))
+
+    results['load'] = measure(lambda: rucola.Rucola(path), repeat)
+    results['load_jobs'] = measure(
+        lambda: rucola.Rucola(path, jobs=jobs), repeat)
+
+    app = rucola.Rucola(path)
+
+    for pattern in ('**/*', '**/*.md', 'd0/**/*.md', '*.html', 'd1/d2/*'):
+        results['find ' + pattern] = measure(
+            lambda: app.find(pattern), repeat)
+
+    results['get x{}'.format(len(sample))] = measure(
+        lambda: [app.get(i) for i in sample], repeat)
+
+    results['use'] = measure(
+        lambda x: x.use(touch_paths, read_some, rename_pages), repeat,
+        setup=lambda: rucola.Rucola(path))
+
+    results['build'] = measure(
+        lambda x: app.build(), repeat, setup=app.clear_output)
+    results['build_jobs'] = measure(
+        lambda x: app.build(jobs=jobs), repeat, setup=app.clear_output)
+
+    app.build(incremental=True)
+    results['build_incremental'] = measure(
+        lambda: app.build(incremental=True), repeat)
+
+    results['clear_output'] = measure(
+        lambda x: app.clear_output(), repeat, setup=app.build)
+
+    return results
+
+
+def compare(old, new, threshold=0.2):
+    """Compares two results dicts. Returns list of ``(name, old, new)``
+    tuples for benchmarks that are slower than `old` by more than
+    `threshold` (0.2 = 20%)."""
+
+    regressions = []
+    for name, t in sorted(new.items()):
+        if name in old and t > old[name] * (1 + threshold):
+            regressions.append((name, old[name], t))
+    return regressions
+
+
+def benchmark(files=1000, depth=3, fanout=4, min_size=256,
+              max_size=64 * 1024, binary=0.2, repeat=3, jobs=4, seed=0):
+    """Generates a site in a temporary directory, runs benchmarks and
+    returns a JSON-ready dict with results and environment details."""
+
+    site = dict(files=files, depth=depth, fanout=fanout, min_size=min_size,
+                max_size=max_size, binary=binary, seed=seed)
+
+    path = tempfile.mkdtemp(prefix='rucola-bench-')
+    try:
+        paths = generate_site(path, **site)
+        results = run(path, paths, repeat=repeat, jobs=jobs)
+    finally:
+        shutil.rmtree(path)
+
+    return {
+        'rucola': rucola.__version__,
+        'python': platform.python_version(),
+        'platform': sys.platform,
+        'site': site,
+        'repeat': repeat,
+        'jobs': jobs,
+        'results': results
+    }
+
+
+def save(data, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,60 @@
+import sys
+import argparse
+
+from benchmarks import benchmark, compare, save, load
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Measures rucola on a synthetic site.')
+
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--min-size', type=int, default=256)
+    parser.add_argument('--max-size', type=int, default=64 * 1024)
+    parser.add_argument('--binary', type=float, default=0.2,
+                        help='fraction of binary files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='PATH',
+                        help='write results to a JSON file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare with results from a JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown, 0.2 = 20%% (default)')
+
+    args = parser.parse_args(argv)
+
+    data = benchmark(files=args.files, depth=args.depth, fanout=args.fanout,
+                     min_size=args.min_size, max_size=args.max_size,
+                     binary=args.binary, repeat=args.repeat, jobs=args.jobs,
+                     seed=args.seed)
+
+    for name, t in sorted(data['results'].items()):
+        print('{:<24} {:>10.4f}s'.format(name, t))
+
+    if args.save:
+        save(data, args.save)
+
+    if args.compare:
+        old = load(args.compare)
+        if old.get('site') != data['site']:
+            print('Warning: results were measured on a different site')
+
+        regressions = compare(old['results'], data['results'],
+                              args.threshold)
+        for name, a, b in regressions:
+            print('Regression: {} {:.4f}s -> {:.4f}s ({:+.0%})'.format(
+                name, a, b, b / a - 1))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
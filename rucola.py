@@ -13,7 +13,6 @@ Good luck!
 # TODO: Logging msgs
 # TODO: Clear code
 # TODO: Clear output during init of Rucola() ?
-# TODO: Drop python 3.2 support
 
 import os
 import sys
@@ -23,19 +22,75 @@ import posixpath
 import shutil
 import logging
 import filecmp
+import stat
+import errno
+import functools
+import itertools
+import asyncio
+import hashlib
+import json
+import gzip
+import io
+import locale
+import zlib
+import pickle
+import threading
+import mmap
+import multiprocessing
+import time
+import tracemalloc
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import KeysView
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __author__ = 'Kasper Minciel'
 __version__ = '0.0.1.dev2'
 __license__ = 'MIT'
 
-# Minimum supported python: 3.2
-if sys.hexversion < 0x030200F0:
-    raise ImportError('Python < 3.2 not supported!')
-
-PYTHON32 = True if sys.hexversion < 0x030300F0 else False
+# Minimum supported python: 3.5
+if sys.hexversion < 0x030500F0:
+    raise ImportError('Python < 3.5 not supported!')
 
 SOURCE_DIR = 'src'
 OUTPUT_DIR = 'build'
+# Build manifest file name, stored in an output directory.
+MANIFEST_FILE = '.rucola-manifest.json'
+# Shard manifest file name, stored in an output directory of a shard.
+SHARD_FILE = '.rucola-shard.json'
+# Hashes of fingerprinted source files, stored in an output directory.
+FINGERPRINT_FILE = '.rucola-fingerprints.json'
+
+# Write policies, see Rucola.build()
+WRITE_ALWAYS = 'always'
+WRITE_IF_CHANGED = 'if-changed'
+WRITE_MTIME = 'mtime'
+WRITE_POLICIES = (WRITE_ALWAYS, WRITE_IF_CHANGED, WRITE_MTIME)
+
+# Size of chunks used when files are compared.
+BUFFER_SIZE = 64 * 1024
+
+# Default size of a content cache in bytes, see ContentCache.
+CACHE_SIZE = 32 * 1024 * 1024
+
+# Directory and default size in bytes of a transform cache, see
+# TransformCache.
+CACHE_DIR = '.rucola-cache'
+TRANSFORM_CACHE_SIZE = 256 * 1024 * 1024
+
+# Compressed sidecar formats and their extensions, see Precompress.
+COMPRESSION_FORMATS = {'gzip': '.gz', 'deflate': '.zz'}
+
+# Passthrough strategies, see Rucola.build()
+PASSTHROUGH_COPY = 'copy'
+PASSTHROUGH_HARDLINK = 'hardlink'
+PASSTHROUGH_REFLINK = 'reflink'
+PASSTHROUGH_SYMLINK = 'symlink'
+PASSTHROUGH_AUTO = 'auto'
 
 # Logging
 
@@ -45,27 +100,252 @@ debug = lambda x: log.debug('  ' + x)
 
 
 
+# Exceptions
+
+class BuildError(Exception):
+    """Raised by :any:`Rucola.build()` when some files cannot be built.
+    The `errors` attribute is a list of ``(file, exception)`` tuples,
+    in the same order as the files were given to build.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        msg = '{} file(s) not built:'.format(len(errors))
+        for f, e in errors:
+            msg += '\n  {}: {!r}'.format(f.path, e)
+        super().__init__(msg)
+
+
+# Results
+
+class BuildResult(namedtuple('BuildResult', 'file written size time')):
+    """Information about one file built by :any:`Rucola.ibuild()`.
+
+        `file`
+            Built :any:`File` instance.
+
+        `written`
+            `False` if a file was skipped, because it did not change.
+
+        `size`
+            Size of a written file in bytes, `0` if a file was skipped.
+
+        `time`
+            Time spent on building a file, in seconds.
+
+    """
+
+    __slots__ = ()
+
+
+class DirDiff(namedtuple('DirDiff',
+                           'added removed changed files bytes time')):
+    """Differences between two directories, see :any:`diff_dirs()`.
+
+        `added`, `removed`, `changed`
+            Sorted lists of paths, relative to compared directories and
+            with '/' separators, of files found only in the second
+            directory, only in the first one, and in both with a different
+            content.
+
+        `files`
+            Total number of files in both directories.
+
+        `bytes`, `time`
+            Bytes read to compare contents and seconds spent on it, see
+            also `throughput`.
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def equal(self):
+        """`True` if directories have the same files and contents."""
+        return not (self.added or self.removed or self.changed)
+
+    @property
+    def throughput(self):
+        """Bytes compared per second."""
+        return self.bytes / self.time if self.time else 0.0
+
+
+class PluginStats(namedtuple('PluginStats',
+                               'name wall cpu memory added removed read')):
+    """Resources used by one plugin call, see `profile` parameter of
+    :any:`Rucola`.
+
+        `name`
+            Plugin representation, or ``build(<target>)`` for builds.
+
+        `wall`, `cpu`
+            Wall clock time and process CPU time in seconds.
+
+        `memory`
+            Peak of memory allocated during a call in bytes, or `None` if
+            `tracemalloc` is not tracing.
+
+        `added`, `removed`
+            Number of files added to and removed from `Rucola.files`.
+
+        `read`
+            Bytes read by :any:`ContentReader` instances.
+
+    """
+
+    __slots__ = ()
+
+
 # Utils
 
 def compare_dirs(a, b):
-    """Returns True if a content of directory `a` is same as a content of `b`."""
+    """Returns True if a content of directory `a` is same as a content of `b`,
+    see :any:`diff_dirs()`."""
+
+    return diff_dirs(a, b).equal
+
+def diff_dirs(a, b, jobs=None):
+    """Compares all files in directory trees `a` and `b` and returns
+    a :any:`DirDiff`. Files with the same size are compared by a hash of
+    their content, computed by `jobs` threads (by default a number of
+    CPUs). Files with different sizes are not read at all.
 
-    def compare(x, a, b):
+    >>> diff = diff_dirs('build', 'expected')
+    >>> diff.changed
+    ['posts/a.html']
+    """
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
 
-        if x.diff_files or x.funny_files:
+        x, y = pool.map(_scan_files, (a, b))
+
+        added = sorted(p for p in y if p not in x)
+        removed = sorted(p for p in x if p not in y)
+        changed = []
+        same_size = []
+        for p in sorted(p for p in x if p in y):
+            if x[p][1] == y[p][1]:
+                same_size.append(p)
+            else:
+                changed.append(p)
+
+        paths = [x[p][0] for p in same_size] + [y[p][0] for p in same_size]
+        hashes = list(pool.map(hash_file, paths))
+
+    n = len(same_size)
+    changed.extend(p for i, p in enumerate(same_size)
+                   if hashes[i] != hashes[i + n])
+    changed.sort()
+
+    return DirDiff(added, removed, changed,
+                   files=len(x) + len(y),
+                   bytes=sum(x[p][1] for p in same_size) * 2,
+                   time=time.perf_counter() - start)
+
+def _scan_files(top):
+    """Returns a dict that maps paths of all files in a `top` directory
+    tree, relative and with '/' separators, to their `(path, size)`."""
+
+    result = {}
+    stack = [(top, '')]
+    while stack:
+        path, prefix = stack.pop()
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                stack.append((entry.path, prefix + entry.name + SEP))
+            else:
+                result[prefix + entry.name] = (entry.path,
+                                               entry.stat().st_size)
+    return result
+
+def hash_file(path):
+    """Returns a hex digest of a file content, read in chunks."""
+
+    h = hashlib.sha1()
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def shard_of(path, shards):
+    """Returns a number of a shard, from `0` to `shards - 1`, that
+    builds an output `path`. It is the same on all machines."""
+
+    path = posixpath.normpath(path.replace(os.sep, SEP))
+    return zlib.crc32(path.encode('utf-8')) % shards
+
+def write_json(path, data):
+    """Writes `data` to a JSON file at `path`, readers never see
+    a partially written file."""
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, sort_keys=True, separators=(',', ':'))
+    os.replace(tmp, path)
+
+def hash_content(content):
+    """Returns a hex digest of a `str` or `bytes` content."""
+
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+def encode_content(content):
+    """Returns data written to a file for a given `str` content or
+    a bytes-like object (`bytes`, `bytearray`, `memoryview`). Text is
+    encoded as utf-8 with platform line endings, bytes-like objects are
+    returned without copying."""
+
+    if isinstance(content, str):
+        if os.linesep != '\n':
+            content = content.replace('\n', os.linesep)
+        return content.encode('utf-8')
+    if isinstance(content, memoryview) and content.format != 'B':
+        return content.cast('B')
+    return content
+
+def same_content(path, data):
+    """Returns `True` if a file at `path` contains exactly `data` bytes.
+    Sizes are compared first, then a file is read in chunks."""
+
+    try:
+        if os.stat(path).st_size != len(data):
             return False
+    except OSError:
+        return False
 
-        for i in x.same_files:
-            if not filecmp.cmp(os.path.join(a, i), os.path.join(b, i), shallow=False):
+    view = memoryview(data)
+    pos = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BUFFER_SIZE)
+            if not chunk:
+                return pos == len(data)
+            if view[pos:pos + len(chunk)] != chunk:
                 return False
+            pos += len(chunk)
 
-        for i in x.subdirs:
-            compare(i, a, b)
+def unlink_shared(path):
+    """Removes a file at `path` if it is a symlink or a hardlink, so
+    writing to it cannot change other files, for example sources linked
+    by a previous build."""
 
-        return True
-
-    dc = filecmp.dircmp(a, b)
-    return compare(dc, a, b)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+        os.unlink(path)
 
 def split_path(path):
     """Split a path using the system-depended separator slash.
@@ -108,11 +388,161 @@ def has_magic(s):
     return match is not None
 
 
+GLOBSTAR = '**'
+
+# Number of compiled patterns kept by compile_pattern().
+PATTERN_CACHE_SIZE = 512
+
+# fnmatch normalizes a case of paths on case-insensitive systems.
+_normcase = None if os.path.normcase('A') == 'A' else os.path.normcase
+
+
+def _compile_segment(pattern):
+    """Returns a literal string or a callable used to match a one path
+    segment, same as the `fnmatch.fnmatch()` would do."""
+
+    if pattern == GLOBSTAR:
+        return GLOBSTAR
+    if not has_magic(pattern):
+        return pattern
+
+    if _normcase is None:
+        return re.compile(fnmatch.translate(pattern)).match
+
+    regex = re.compile(fnmatch.translate(_normcase(pattern))).match
+    return lambda x: regex(_normcase(x))
+
+
+class Pattern:
+    """Compiled glob pattern. Use :any:`compile_pattern()` to create it,
+    compiled patterns are cached there.
+
+    The pattern is split and each segment is compiled only once, so testing
+    a path is a simple loop over its segments:
+
+    >>> p = Pattern('posts/**/*.md')
+    >>> p.match('posts/2015/hello.md')
+    True
+    >>> p.prefix
+    'posts/'
+
+    Attributes:
+
+        `pattern`
+            Original pattern string.
+
+        `prefix`
+            Leading directories without glob syntax. Every matched path
+            starts with it, it can be used to skip not matching directories.
+
+        `literal`
+            `True` if a pattern does not use glob syntax at all.
+
+    """
+
+    def __init__(self, pattern):
+
+        self.pattern = pattern
+        self.segments = [_compile_segment(i) for i in pattern.split(SEP)]
+        self.literal = not has_magic(pattern)
+
+        prefix = []
+        for i in self.segments[:-1]:
+            if i is GLOBSTAR or i.__class__ is not str:
+                break
+            prefix.append(i)
+        self.prefix = SEP.join(prefix) + SEP if prefix else ''
+
+        if self.literal:
+            self.match = self._match_literal
+        elif GLOBSTAR in self.segments:
+            self.match = self._match_globstar
+        else:
+            self.match = self._match_segments
+
+    def __repr__(self):
+        return 'Pattern({!r})'.format(self.pattern)
+
+    def _match_literal(self, path):
+        return path == self.pattern
+
+    def _match_segments(self, path):
+
+        a = path.split(SEP)
+        if len(a) != len(self.segments):
+            return False
+
+        for x, p in zip(a, self.segments):
+            if p.__class__ is str:
+                if x != p:
+                    return False
+            elif p(x) is None:
+                return False
+        return True
+
+    def _match_globstar(self, path):
+
+        # Same steps as the old list.pop(0) based pathmatch(), but using
+        # indexes and precompiled segments. The `**` segment consumes all
+        # path segments except the last ones, required by the rest
+        # of a pattern.
+
+        a, b = path.split(SEP), self.segments
+        a_len, b_len = len(a), len(b)
+        ai = bi = 0
+        b_set = None
+
+        while True:
+
+            if ai == a_len and bi == b_len:
+                return True
+
+            if ai == a_len or (bi == b_len and b_set is not GLOBSTAR):
+                return False
+
+            a_set = a[ai]
+            ai += 1
+
+            if b_set is not GLOBSTAR:
+                b_set = b[bi]
+                bi += 1
+
+            if b_set is GLOBSTAR and bi < b_len:
+
+                ai = max(ai, a_len - (b_len - bi))
+                b_set = b[bi]
+                bi += 1
+                if ai < a_len:
+                    a_set = a[ai]
+                    ai += 1
+
+            if b_set is GLOBSTAR:
+                continue
+            if b_set.__class__ is str:
+                if a_set != b_set:
+                    return False
+            elif b_set(a_set) is None:
+                return False
+
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern):
+    """Returns a :any:`Pattern` instance for a given `pattern` string.
+    Results are kept in a LRU cache, so compiling a same pattern again
+    costs almost nothing.
+
+    >>> compile_pattern('**/*.html').match('about/index.html')
+    True
+    """
+
+    return Pattern(pattern)
+
+
 def pathmatch(path, pattern):
     """Returns `True` if `path` matches a pattern, else `False`.
-    Supports a glob syntax. I don't remember how does it works,
-    it splits `path` and `pattern` and compare elements using
-    the python `fnmatch` module.
+    Supports a glob syntax. It splits `path` and `pattern` and compare
+    elements using the python `fnmatch` rules. A pattern is compiled only
+    once, see :any:`compile_pattern()`.
 
     Example:
 
@@ -125,50 +555,593 @@ def pathmatch(path, pattern):
 
     """
 
-    a, b = path.split(SEP), pattern.split(SEP)
-    b_set = None
+    return compile_pattern(pattern).match(path)
 
-    while True:
+# Passthrough
+# Functions used to write files that content was not changed. Each one
+# replaces an existing output file.
 
-        if not a and not b:
-            return True
+def copy_file(source, output):
+    """Copies a file data and permission bits, like `shutil.copy()`."""
 
-        if not a or (not b and not b_set == '**'):
-            return False
+    unlink_shared(output)
+    shutil.copy(source, output)
 
-        a_set = a.pop(0)
+def hardlink_file(source, output):
+    """Creates a hard link. Source and output must be on the same
+    filesystem."""
 
-        if b_set != '**':
-            b_set = b.pop(0)
+    _remove_file(output)
+    os.link(source, output)
 
-        if b_set == '**' and b:
+def symlink_file(source, output):
+    """Creates a symbolic link pointing to an absolute source path."""
 
-            a = a[-len(b):]
-            b_set = b.pop(0)
-            if a: a_set = a.pop(0)
+    _remove_file(output)
+    os.symlink(os.path.abspath(source), output)
+
+# ioctl request that clones a file data, from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink_file(source, output):
+    """Creates a copy-on-write clone of a file (btrfs, xfs). Raises
+    `OSError` if it is not supported by a system or a filesystem, an empty
+    output file is not left behind then."""
+
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks not supported', output)
+
+    unlink_shared(output)
+    with open(source, 'rb') as src, open(output, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            _remove_file(output)
+            raise
+    shutil.copymode(source, output)
+
+def kernel_copy_file(source, output):
+    """Copies a file data inside a kernel using `os.copy_file_range()` or
+    `os.sendfile()`. Raises `OSError` if none of them is available."""
+
+    copy_range = getattr(os, 'copy_file_range', None)
+    sendfile = getattr(os, 'sendfile', None)
+    if copy_range is None and sendfile is None:
+        raise OSError(errno.ENOSYS, 'Kernel copy not supported', output)
+
+    unlink_shared(output)
+    with open(source, 'rb') as src, open(output, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        while offset < size:
+            if copy_range is not None:
+                n = copy_range(src.fileno(), dst.fileno(), size - offset)
+            else:
+                n = sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if not n:
+                break
+            offset += n
+    shutil.copymode(source, output)
+
+def auto_copy_file(source, output):
+    """Uses the cheapest available method: a reflink, a kernel copy and at
+    the end a normal copy. Hard links are not used, an output must not
+    share data with a source."""
+
+    for i in (reflink_file, kernel_copy_file):
+        try:
+            return i(source, output)
+        except OSError:
+            pass
+    copy_file(source, output)
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+PASSTHROUGH = {
+    PASSTHROUGH_COPY: copy_file,
+    PASSTHROUGH_HARDLINK: hardlink_file,
+    PASSTHROUGH_REFLINK: reflink_file,
+    PASSTHROUGH_SYMLINK: symlink_file,
+    PASSTHROUGH_AUTO: auto_copy_file
+}
+
+def merge_shards(output, shards, passthrough=PASSTHROUGH_COPY):
+    """Copies files built by all shards (see :any:`Rucola.build()`)
+    from `shards` output directories to an `output` directory, using
+    a `passthrough` strategy. Returns list of merged paths.
+
+    >>> merge_shards('build', ['build-0', 'build-1', 'build-2'])
+
+    Raises a `ValueError` before anything is copied if a shard is missing
+    or duplicated, or if the same output path was built by two shards.
+    """
+
+    copy = PASSTHROUGH[passthrough]
+    found = {}
+    paths = {}
+    errors = []
+
+    for directory in shards:
+        with open(os.path.join(directory, SHARD_FILE), encoding='utf-8') as f:
+            data = json.load(f)
+
+        shard = (data['shard'], data['shards'])
+        if shard in found:
+            errors.append('Shard {} of {} found in {} and {}'.format(
+                shard[0], shard[1], found[shard], directory))
+        found[shard] = directory
+
+        for path in data['files']:
+            key = os.path.normcase(posixpath.normpath(path))
+            if key in paths:
+                errors.append('Output path {} built by {} and {}'.format(
+                    path, paths[key][0], directory))
+            else:
+                paths[key] = (directory, path)
+
+    counts = set(i[1] for i in found)
+    if len(counts) > 1:
+        errors.append('Shards of different builds: {}'.format(
+            sorted(counts)))
+    elif counts:
+        count = counts.pop()
+        for i in range(count):
+            if (i, count) not in found:
+                errors.append('Shard {} of {} is missing'.format(i, count))
+
+    if errors:
+        raise ValueError('Cannot merge shards:\n' + '\n'.join(errors))
+
+    result = []
+    for directory, path in paths.values():
+        target = os.path.join(output, *path.split(SEP))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        copy(os.path.join(directory, *path.split(SEP)), target)
+        result.append(path)
+
+    info('Merged {} files from {} shards'.format(len(result), len(found)))
+    return result
+
+
+def compress_file(path, formats=('gzip',), level=9, min_size=0):
+    """Writes compressed copies of a file at `path` next to it, for
+    example ``index.html.gz``, in all `formats` (see
+    :any:`COMPRESSION_FORMATS`). Sidecars get a modification time of
+    a file. If a file is smaller than `min_size` bytes, its old sidecars
+    are removed instead. Returns a total size of written sidecars."""
+
+    st = os.stat(path)
+    if st.st_size < min_size:
+        for i in formats:
+            _remove_file(path + COMPRESSION_FORMATS[i])
+        return 0
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    total = 0
+    for i in formats:
+        if i == 'gzip':
+            buffer = io.BytesIO()
+            with gzip.GzipFile(filename='', mode='wb', fileobj=buffer,
+                               compresslevel=level, mtime=0) as f:
+                f.write(data)
+            compressed = buffer.getvalue()
+        else:
+            compressed = zlib.compress(data, level)
+
+        sidecar = path + COMPRESSION_FORMATS[i]
+        tmp = sidecar + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(compressed)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, sidecar)
+        total += len(compressed)
+
+    return total
 
-        if has_magic(b_set):
-            if not fnmatch.fnmatch(a_set, b_set):
-                return False
-        elif a_set != b_set:
-            return False
 
 # Main classes
 
 
+class ContentCache:
+    """Keeps recently read file contents in memory, used by
+    :any:`ContentReader`. Contents are keyed by a path, a modification time
+    and a size of a file, so a changed file is always read again. When
+    the total size of cached files is bigger than `size` bytes, the least
+    recently used contents are removed.
+
+    Attributes `hits`, `misses` and `evictions` count cache usage, see
+    also :any:`stats()`.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+
+        self.size = size
+        self.used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # (path, binary, offset) => (mtime, size, content)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def read(self, path, reader, binary=False, offset=0):
+        """Returns a content of a file at `path`. If it is not cached,
+        `reader(path)` is called to read it. Text and `binary` contents
+        of the same file, and contents read from different `offset`, are
+        cached separately."""
+
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        name = (path, binary, offset)
+
+        with self._lock:
+            item = self._data.get(name)
+            if item is not None and item[:2] == key:
+                self._data.move_to_end(name)
+                self.hits += 1
+                return item[2]
+            self.misses += 1
+
+        content = reader(path)
+        if st.st_size > self.size:
+            return content
+
+        with self._lock:
+            old = self._data.pop(name, None)
+            if old is not None:
+                self.used -= old[1]
+            self._data[name] = key + (content,)
+            self.used += st.st_size
+
+            while self.used > self.size:
+                x = self._data.popitem(last=False)[1]
+                self.used -= x[1]
+                self.evictions += 1
+
+        return content
+
+    def clear(self):
+        """Removes all cached contents."""
+
+        with self._lock:
+            self._data.clear()
+            self.used = 0
+
+    def stats(self):
+        """Returns a dict with a cache usage statistics."""
+
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'files': len(self._data),
+                'used': self.used,
+                'size': self.size}
+
+
+class TransformCache:
+    """Stores results of plugins in a `path` directory, so they survive
+    between processes and can be restored by a CI. Used by
+    :any:`Rucola.cached()`. Each result is a pickled value in its own file,
+    named by a key. When the total size of results is bigger than `size`
+    bytes, the least recently used results are removed.
+
+    Attributes `hits`, `misses` and `evictions` count cache usage, see
+    also :any:`stats()`. Broken results are treated as missing.
+    """
+
+    def __init__(self, path, size=TRANSFORM_CACHE_SIZE):
+
+        self.path = path
+        self.size = size
+        # Unknown until the first write.
+        self.used = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """Returns a key made from `parts`, strings or bytes."""
+
+        h = hashlib.sha1()
+        for i in parts:
+            if isinstance(i, str):
+                i = i.encode('utf-8')
+            h.update(str(len(i)).encode('ascii') + b':')
+            h.update(i)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, default=None):
+        """Returns a value stored with a `key` or a `default`."""
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # Last used time, see _evict()
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+                AttributeError, ImportError, IndexError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return default
+
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Stores a `value` with a `key`. Values that cannot be pickled
+        are not stored."""
+
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            debug('Cannot cache: ' + repr(value))
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            old = os.stat(path).st_size
+        except OSError:
+            old = 0
+        os.replace(tmp, path)
+
+        with self._lock:
+            if self.used is None:
+                self.used = sum(st.st_size for p, st in self._entries())
+            else:
+                self.used += len(data) - old
+            if self.used > self.size:
+                self._evict()
+
+    def _entries(self):
+        """Yields `(path, stat)` of all stored results."""
+
+        try:
+            dirs = list(os.scandir(self.path))
+        except OSError:
+            return
+        for d in dirs:
+            if not d.is_dir():
+                continue
+            for i in os.scandir(d.path):
+                if not i.name.endswith('.tmp'):
+                    try:
+                        yield i.path, i.stat()
+                    except OSError:
+                        pass
+
+    def _evict(self):
+        """Removes the least recently used results until the total size
+        is smaller than `size`."""
+
+        entries = sorted(self._entries(), key=lambda x: x[1].st_mtime_ns)
+        self.used = sum(st.st_size for p, st in entries)
+        for path, st in entries:
+            if self.used <= self.size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.used -= st.st_size
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all stored results."""
+
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.used = 0
+
+    def stats(self):
+        """Returns a dict with a cache usage statistics."""
+
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'used': self.used,
+                'size': self.size}
+
+
+class FileStat(namedtuple('FileStat', 'st_size st_mtime_ns')):
+    """Part of `os.stat_result` used by rucola: a size and a modification
+    time in nanoseconds. It is much smaller than a full stat result."""
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, stat):
+        """Returns a :any:`FileStat` of an `os.stat_result`."""
+        return cls(stat.st_size, stat.st_mtime_ns)
+
+
 class ContentReader:
     """When called it opens a `self.path` file and reads it. That is all.
     It is used by :any:`File` instances to save memory. Without it all
     instances store their contents directly in a ``content`` key, even when
     they are not used. Using this class, a content is read and returned only
     when needed.
+
+    If a :any:`ContentCache` is given, a content is read only once and
+    taken from a cache later, until a file changes.
+
+    A content is returned as a `str`, or as `bytes` if `binary` is `True`.
+    Use :any:`read_bytes()` or :any:`view()` to access binary files
+    without changing a `binary` mode.
+
+    A content starts at an `offset` in bytes, it is set by
+    :any:`split_header()`, so a file header is not read again with
+    a content. Use :any:`head()` to look at a beginning of a file.
+
+    The `ContentReader.bytes_read` class attribute counts bytes read
+    by all instances, it is used by :any:`Rucola` plugins statistics.
     """
-    def __init__(self, path):
+
+    bytes_read = 0
+
+    # A directory part of a path is interned, so it is shared by all
+    # readers of files in the same directory.
+    __slots__ = ('_dir', '_name', 'cache', 'binary', '_stat', 'offset')
+
+    def __init__(self, path, cache=None, binary=False, stat=None, offset=0):
         self.path = path
+        self.cache = cache
+        self.binary = binary
+        self._stat = None if stat is None else FileStat.of(stat)
+        self.offset = offset
+
+    @property
+    def path(self):
+        """Path to a file."""
+        return os.path.join(self._dir, self._name)
+
+    @path.setter
+    def path(self, value):
+        head, self._name = os.path.split(value)
+        self._dir = sys.intern(head)
+
+    def stat(self):
+        """Returns a :any:`FileStat` of a file. It is taken only once,
+        usually when a file is loaded by :any:`Rucola`."""
+
+        if self._stat is None:
+            self._stat = FileStat.of(os.stat(self.path))
+        return self._stat
 
     def __call__(self, *args, **kwargs):
-        with open(self.path) as f:
-            return f.read()
+        if self.binary:
+            return self.read_bytes()
+        return self._cached(self._read, False)
+
+    def _cached(self, reader, binary):
+        """Reads a content from `self.offset` by a `reader` function,
+        using a cache if it is set."""
+
+        if self.offset:
+            reader = functools.partial(reader, offset=self.offset)
+        if self.cache is not None:
+            return self.cache.read(self.path, reader, binary, self.offset)
+        return reader(self.path)
+
+    @staticmethod
+    def _read(path, offset=0):
+        with open(path) as f:
+            if offset:
+                # A byte offset, not a text cookie, see split_header()
+                f.buffer.seek(offset)
+            content = f.read()
+            ContentReader.bytes_read += f.buffer.tell() - offset
+        return content
+
+    @staticmethod
+    def _read_bytes(path, offset=0):
+        with open(path, 'rb') as f:
+            if offset:
+                f.seek(offset)
+            content = f.read()
+        ContentReader.bytes_read += len(content)
+        return content
+
+    def read_bytes(self):
+        """Returns a file content as `bytes`."""
+        return self._cached(self._read_bytes, True)
+
+    def head(self, n=1024):
+        """Returns first `n` characters of a file, or `n` bytes if
+        a reader is `binary`. Only they are read, an `offset` is ignored."""
+
+        with open(self.path, 'rb' if self.binary else 'r') as f:
+            content = f.read(n)
+            ContentReader.bytes_read += f.tell() if self.binary else \
+                f.buffer.tell()
+        return content
+
+    def split_header(self, delimiter='---', limit=64 * 1024):
+        """Returns a header at the beginning of a file, between two lines
+        with a `delimiter`, like a YAML front matter. Later a content
+        is read from the end of a header (see `offset`), so a header is
+        not a part of it. Returns `None` if a file does not start with
+        a header or it is longer than `limit` bytes:
+
+        >>> reader = file.get_buffer()
+        >>> header = reader.split_header()
+        >>> if header is not None:
+        >>>     file.update(yaml.safe_load(header))
+
+        Only a header is read, so it is cheap to sort or filter a lot of
+        files by their metadata.
+        """
+
+        # Read as bytes, so an offset is a real position in a file. It is
+        # decoded like a text file opened by open().
+        encoding = locale.getpreferredencoding(False)
+        delimiter = delimiter.encode(encoding)
+
+        lines = []
+        with open(self.path, 'rb') as f:
+            try:
+                line = f.readline(limit)
+                size = len(line)
+                if line.rstrip(b'\r\n') == delimiter:
+                    while size < limit:
+                        line = f.readline(limit - size)
+                        size += len(line)
+                        if not line:
+                            break
+                        if line.rstrip(b'\r\n') == delimiter:
+                            self.offset = f.tell()
+                            header = b''.join(lines).decode(encoding)
+                            return header.replace('\r\n', '\n')
+                        lines.append(line)
+            finally:
+                ContentReader.bytes_read += f.tell()
+        return None
+
+    def view(self):
+        """Returns a read-only `memoryview` of a file mapped to memory.
+        Only the parts that are used are read from a disk, so it is cheap
+        to look at headers or hash big files. The view can be used as
+        a context manager, which releases it:
+
+        >>> with file.get_buffer().view() as data:
+        >>>     is_png = data[:8] == b'\\x89PNG\\r\\n\\x1a\\n'
+        """
+
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= self.offset:
+                return memoryview(b'')
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.offset:
+            return memoryview(data)[self.offset:]
+        return memoryview(data)
 
 
 class File(dict):
@@ -195,27 +1168,76 @@ class File(dict):
             If a key is not found, look for it in this dict. For example used
             to get access to global ``Rucola.metadata``.
 
+    To keep instances small, ``path`` and ``content`` are stored in slots
+    and only other keys are stored in a dict, so a file without metadata
+    has an empty one. They still work like normal keys, but they cannot
+    be removed. Paths are interned.
+
     """
 
+    __slots__ = ('_path', '_content', 'globals', '_lists', '_source',
+                 '_depends')
+
+    # Keys stored in slots, always present.
+    KEYS = ('path', 'content')
+
     def __init__(self, path, content=None, global_metadata=None):
         super().__init__()
 
         self.globals = global_metadata
+        # FileList instances that index this file by its path.
+        self._lists = ()
 
-        self['path'] = path
+        self._path = _intern(path)
         if content is None:
             content = ''
-        self['content'] = content
+        self._content = content
+        # ContentReader of a source file, kept when a content is changed.
+        self._source = content if isinstance(content, ContentReader) else None
+        # Files that an output depends on, see Rucola.depends()
+        self._depends = ()
+        for i in _trackers:
+            i.write(self)
 
     def __repr__(self):
         return 'File({})'.format(self.path)
 
+    def __reduce__(self):
+        return (self.__class__, (self._path, self._content, self.globals),
+                self._source, None, iter(dict.items(self)))
+
+    def __setstate__(self, state):
+        self._source = state
+
+    def __setitem__(self, key, value):
+
+        if key == 'path':
+            old = self._path
+            self._path = _intern(value)
+            for i in self._lists:
+                i._moved(self, old)
+        elif key == 'content':
+            self._content = value
+            for i in _trackers:
+                i.write(self)
+        else:
+            dict.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
     def __getitem__(self, key):
 
+        if key == 'path':
+            return self._path
         if key == 'content':
-            x = dict.__getitem__(self, key)
+            for i in _trackers:
+                i.read(self)
+            x = self._content
             if callable(x):
                 return x()
+            return x
         try:
             return dict.__getitem__(self, key)
         except KeyError:
@@ -223,25 +1245,92 @@ class File(dict):
                 return self.globals[key]
             raise
 
+    def __delitem__(self, key):
+        if key in self.KEYS:
+            raise KeyError('Cannot remove a file {!r}'.format(key))
+        dict.__delitem__(self, key)
+
+    # Dict methods that must see slots.
+
+    def __contains__(self, key):
+        return key in self.KEYS or dict.__contains__(self, key)
+
+    def __iter__(self):
+        return itertools.chain(self.KEYS, dict.__iter__(self))
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, File):
+            other = dict(other.items())
+        elif not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        """Returns list of ``(key, value)`` pairs. A ``content`` value is
+        not read, it can be a :any:`ContentReader`."""
+        return [('path', self._path), ('content', self._content)] + \
+            list(dict.items(self))
+
+    def values(self):
+        return [v for k, v in self.items()]
+
+    def get(self, key, default=None):
+        if key == 'path':
+            return self._path
+        if key == 'content':
+            return self._content
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        if key in self.KEYS:
+            return self.get(key)
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *default):
+        if key in self.KEYS:
+            raise KeyError('Cannot remove a file {!r}'.format(key))
+        return dict.pop(self, key, *default)
+
+    def copy(self):
+        """Returns a dict with all keys."""
+        return dict(self.items())
+
     #
 
     def has_buffer(self):
         """Returns `True` if a `content` is not set and it is dynamically
         read from filesystem.
         """
-        x = dict.__getitem__(self, 'content')
-        return isinstance(x, ContentReader)
+        return isinstance(self._content, ContentReader)
 
     def get_buffer(self):
         """Returns object that is used to read `content` from a filesystem."""
-        return dict.__getitem__(self, 'content')
+        return self._content
+
+    @property
+    def source(self):
+        """Path to a source file that a file was loaded from, even if its
+        `content` was changed later. `None` for files created in memory."""
+        return None if self._source is None else self._source.path
 
     # Shortcuts
 
     @property
     def path(self):
         """Same as a `self['path']`"""
-        return self['path']
+        return self._path
 
     @path.setter
     def path(self, value):
@@ -260,6 +1349,683 @@ class File(dict):
         self['content'] = value
 
 
+def _intern(path):
+    return sys.intern(path) if type(path) is str else path
+
+
+def _depends_of(file):
+    """Yields files that a `file` depends on directly. Files shared with
+    other files are stored as a tuple in `File._depends`, see
+    :any:`Rucola.depends()`."""
+
+    for i in file._depends:
+        if type(i) is tuple:
+            yield from i
+        else:
+            yield i
+
+
+def _map_file(transform, data):
+    """Calls a `transform` for a file `data`, see :any:`Rucola.map()`.
+    A not changed content is not returned, so it is not sent back from
+    a worker process."""
+
+    content = data['content']
+    if isinstance(content, ContentReader):
+        data['content'] = content = content()
+
+    result = transform(data)
+    if result is not None and result.get('content') is content:
+        result = dict(result)
+        del result['content']
+    return result
+
+
+async def _notify(callback, *args):
+    """Calls a `callback`, which can be a normal function or
+    a coroutine function."""
+
+    result = callback(*args)
+    if asyncio.iscoroutine(result):
+        await result
+
+
+class _Tracker:
+    """Files whose content was read and set while a plugin was running.
+    A set or created file gets files read since the previous one was set,
+    so a plugin that reads one file for each file it makes does not make
+    all of them depend on all its reads. Files read before the first one
+    was set, like a layout read before a loop, are shared by all of them
+    as one list."""
+
+    __slots__ = ('reads', 'shared', 'writes')
+
+    def __init__(self):
+        # Files read since the last write
+        self.reads = {}
+        # Files read before the first write
+        self.shared = None
+        # id(file) => (file, list of files read before it was set)
+        self.writes = {}
+
+    def read(self, file):
+        self.reads[id(file)] = file
+
+    def write(self, file):
+        if self.shared is None:
+            self.shared = list(self.reads.values())
+            self.reads.clear()
+        item = self.writes.get(id(file))
+        if item is None:
+            item = self.writes[id(file)] = (file, [])
+        item[1].extend(self.reads.values())
+        self.reads.clear()
+
+
+# Active trackers, see Rucola.use()
+_trackers = []
+
+
+class Manifest:
+    """Stores information about files written to an output directory.
+    Used by incremental builds to skip files that did not change since
+    the previous build. It is saved as a JSON file in an output directory.
+
+    Entries are dicts stored in a `files` dict, keyed by an output path:
+
+        `source`, `mtime`, `size`
+            Path, modification time (ns) and size of a source file that
+            a file was loaded from, see :any:`File.source`.
+
+        `hash`
+            Hash of a content set in memory, see :any:`hash_content()`.
+
+        `output`, `output_mtime`, `output_size`
+            Path relative to an output directory, modification time (ns) and
+            size of an output file after it was written.
+
+        `depends`
+            Dependencies of a file, see :any:`Rucola.depends()`. A dict
+            that maps a source path to its ``[mtime, size]``, or an output
+            path of a file with a content set in memory to `None`.
+
+        `groups`
+            Keys of dependencies shared with other files in a `groups`
+            dict.
+
+    Dependencies shared by many files are stored once in a `groups` dict,
+    keyed by a hash of their state. Its values are dicts with `depends`
+    and `groups` keys, like entries.
+
+    A missing or broken manifest file is treated as an empty one.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+
+        self.path = path
+        self.files = {}
+        self.groups = {}
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+                self.groups = data['groups']
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def save(self):
+        """Writes a manifest to a `self.path`. Groups not used by any
+        entry are dropped."""
+
+        # Copies, files can be still written by other threads.
+        files = dict(self.files)
+        groups = dict(self.groups)
+
+        used = set()
+        stack = [k for i in files.values() for k in i.get('groups', ())]
+        while stack:
+            key = stack.pop()
+            if key not in used and key in groups:
+                used.add(key)
+                stack.extend(groups[key]['groups'])
+
+        write_json(self.path, {'version': self.VERSION, 'files': files,
+                               'groups': {k: groups[k] for k in used}})
+
+
+class OutputWriter:
+    """Writes :any:`File` instances to an `output` directory, used by
+    :any:`Rucola.ibuild()`. Output directories of all files are created
+    at once by :any:`plan()`, so :any:`write()` does not check them for
+    each file. One writer can be shared by many threads.
+
+    Initialization parameters:
+
+        `output`
+            Path to an output directory, it must exist.
+
+        `write (default: 'always')`
+            A write policy, see :any:`Rucola.build()`.
+
+        `passthrough (default: copy_file)`
+            A function `passthrough(source, output)` that writes files with
+            not changed content.
+
+    """
+
+    def __init__(self, output, write=WRITE_ALWAYS, passthrough=copy_file):
+
+        self.output = output
+        self.write_policy = write
+        self.passthrough = passthrough
+        # Output directories known to exist, relative with '/' separators.
+        self.dirs = set([''])
+
+    def plan(self, files):
+        """Creates output directories of all `files`, parents first.
+        Returns a number of created directories."""
+
+        dirs = set()
+        for i in files:
+            path = posixpath.dirname(posixpath.normpath(i.path))
+            while path not in self.dirs and path not in dirs:
+                dirs.add(path)
+                path = posixpath.dirname(path)
+
+        created = 0
+        for path in sorted(dirs, key=lambda x: (x.count(SEP), x)):
+            try:
+                os.mkdir(os.path.join(self.output, path))
+                created += 1
+            except FileExistsError:
+                pass
+        self.dirs.update(dirs)
+        return created
+
+    def write(self, file):
+        """Write `content` of :any:`File` instance to an `output`
+        directory. Files with not changed content are written by
+        a `passthrough` function. Returns a size of a written file or
+        `None` if it was not written because of a write policy."""
+
+        debug(file.path)
+
+        path = posixpath.dirname(posixpath.normpath(file.path))
+        if path not in self.dirs:
+            # Not planned, for example a path changed after plan().
+            os.makedirs(os.path.join(self.output, path), exist_ok=True)
+            self.dirs.add(path)
+
+        output = os.path.join(self.output, file.path)
+        write = self.write_policy
+
+        # A content that starts at an offset is not a copy of a source.
+        if file.has_buffer() and not file.get_buffer().offset:
+            source = file.get_buffer().path
+
+            if write == WRITE_MTIME:
+                try:
+                    a, b = file.get_buffer().stat(), os.stat(output)
+                    if a.st_size == b.st_size and \
+                            a.st_mtime_ns <= b.st_mtime_ns:
+                        return None
+                except OSError:
+                    pass
+            elif write == WRITE_IF_CHANGED:
+                if os.path.exists(output) and (
+                        os.path.samefile(source, output) or
+                        filecmp.cmp(source, output, shallow=False)):
+                    return None
+
+            self.passthrough(source, output)
+            return file.get_buffer().stat().st_size
+
+        data = encode_content(file.content)
+        if write != WRITE_ALWAYS and same_content(output, data):
+            return None
+
+        unlink_shared(output)
+        with open(output, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+
+class MapPlugin:
+    """Base class of per-file plugins. :any:`Rucola.use()` calls them by
+    :any:`Rucola.map()` instead of calling them, so a `transform` can run
+    in many processes:
+
+    >>> class Upper(MapPlugin):
+    >>>     pattern = '**/*.md'
+    >>>     @staticmethod
+    >>>     def transform(data):
+    >>>         data['content'] = data['content'].upper()
+    >>>         return data
+    >>> app.use(Upper())
+
+    Attributes:
+
+        `pattern`
+            Files that match this pattern are transformed.
+
+        `transform`
+            Function called with data of each file, see :any:`Rucola.map()`.
+
+        `jobs (default: None)`
+            Number of processes, see :any:`Rucola.map()`.
+    """
+
+    pattern = None
+    transform = None
+    jobs = None
+
+
+def _process_pool(jobs):
+    """Returns a `ProcessPoolExecutor` that can be used from many threads.
+    Processes are not forked from a process that runs other threads, they
+    are started by a fork server or spawned, so a script that builds must
+    use an ``if __name__ == '__main__':`` guard."""
+
+    if sys.hexversion < 0x030700F0:
+        # No mp_context, start all forked workers now, from this thread.
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        pool.submit(int).result()
+        return pool
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=context)
+
+
+class Precompress:
+    """Compressed sidecars written by a build next to output files, for
+    example ``index.html.gz`` for nginx ``gzip_static``. Files are
+    compressed by a pool of processes, while other files are still being
+    written. See `compress` parameter of :any:`Rucola.build()`:
+
+    >>> app.build(compress=Precompress('**/*.html', '**/*.css', level=6))
+
+    Initialization parameters:
+
+        `patterns`
+            Only output paths that match one of these patterns are
+            compressed. By default text files: html, css, js, json, xml,
+            svg and txt.
+
+        `level (default: 9)`
+            Compression level, from `1` to `9`.
+
+        `min_size (default: 1024)`
+            Files smaller than this size in bytes are not compressed.
+
+        `formats (default: ('gzip',))`
+            Names of formats from :any:`COMPRESSION_FORMATS`.
+
+        `jobs`
+            Number of processes, by default a number of CPUs.
+
+    Sidecars of files that were not written by a build, because they did
+    not change, are written again only when they are missing or older
+    than a file.
+
+    Processes are not forked from build threads, they are started by
+    a fork server or spawned. So a build script must use an
+    ``if __name__ == '__main__':`` guard.
+    """
+
+    PATTERNS = ('**/*.html', '**/*.css', '**/*.js', '**/*.json',
+                '**/*.xml', '**/*.svg', '**/*.txt')
+
+    def __init__(self, *patterns, level=9, min_size=1024, formats=('gzip',),
+                 jobs=None):
+
+        for i in formats:
+            if i not in COMPRESSION_FORMATS:
+                raise ValueError('Unknown compression format: ' + repr(i))
+
+        self.patterns = patterns or self.PATTERNS
+        self.level = level
+        self.min_size = min_size
+        self.formats = tuple(formats)
+        self.jobs = jobs
+
+        self._match = [compile_pattern(i).match for i in self.patterns]
+        self._pool = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def match(self, path):
+        """Returns `True` if an output `path` should be compressed."""
+        return any(i(path) for i in self._match)
+
+    def _fresh(self, output):
+        """Returns `True` if sidecars of a not changed `output` file
+        do not have to be written again."""
+
+        st = os.stat(output)
+        if st.st_size < self.min_size:
+            return True
+        for i in self.formats:
+            try:
+                if os.stat(output + COMPRESSION_FORMATS[i]).st_mtime_ns != \
+                        st.st_mtime_ns:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def start(self):
+        """Starts a pool of processes, if it is not running. A build calls
+        it before its threads start, see :any:`_process_pool()`."""
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = _process_pool(self.jobs)
+
+    def submit(self, file, output, written=True):
+        """Starts compressing a `file` written to an `output` path, if it
+        matches `patterns`. Not `written` files are compressed only if
+        their sidecars are stale."""
+
+        if not self.match(file.path):
+            return
+        if not written and self._fresh(output):
+            return
+
+        self.start()
+        with self._lock:
+            self._pending.append((file, self._pool.submit(
+                compress_file, output, self.formats, self.level,
+                self.min_size)))
+
+    def finish(self, cancel=False):
+        """Waits until all files are compressed, or for files that are
+        already being compressed if `cancel` is `True`. Returns a list
+        of ``(file, exception)`` tuples of failed files."""
+
+        with self._lock:
+            pool, pending = self._pool, self._pending
+            self._pool, self._pending = None, []
+
+        errors = []
+        if cancel:
+            for file, future in pending:
+                future.cancel()
+        else:
+            for file, future in pending:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((file, e))
+        if pool is not None:
+            pool.shutdown()
+        return errors
+
+
+class _Directory:
+    """Node of a directory tree used by :any:`FileList`."""
+
+    __slots__ = ('dirs', 'files')
+
+    def __init__(self):
+        self.dirs = {}
+        self.files = {}
+
+    def walk(self):
+        """Iterate all files in this directory and its subdirectories."""
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for i in node.files.values():
+                yield i
+            stack.extend(node.dirs.values())
+
+
+class FileList(list):
+    """List of :any:`File` instances, used as a :any:`Rucola.files`.
+    It works exactly like a normal list, but it also keeps an index of
+    file paths, so it can find a file by its path without testing every
+    file in the list.
+
+    The index is created when needed and it is kept up to date when files
+    are added, removed or when their `path` changes. Operations that
+    reorder a list, like `sort()` or `insert()`, just drop the index,
+    it is created again during the next lookup.
+    """
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self._drop_index()
+
+    # Index
+
+    def _drop_index(self):
+        self._paths = None  # path => [File, ...] in a list order
+        self._order = None  # id(File) => position in a list
+        self._tree = None   # _Directory
+        self._next = 0
+        self._repeated = False  # Same instance is more than once in a list
+
+    def _detach(self):
+        """Drops the index and stops receiving path changes from files."""
+
+        if self._order is not None:
+            for i in self:
+                i._lists = tuple(x for x in i._lists if x is not self)
+        self._drop_index()
+
+    def _build_index(self):
+
+        self._paths = {}
+        self._order = {}
+        self._tree = _Directory()
+        self._next = 0
+
+        for file in self:
+            if id(file) in self._order:
+                self._repeated = True
+            else:
+                self._add(file)
+
+    def _node(self, path, create=False):
+        """Returns a directory node for a file `path` or `None`."""
+
+        node = self._tree
+        for name in path.split(SEP)[:-1]:
+            child = node.dirs.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = node.dirs[name] = _Directory()
+            node = child
+        return node
+
+    def _add(self, file):
+
+        if not any(x is self for x in file._lists):
+            file._lists += (self,)
+
+        self._order[id(file)] = self._next
+        self._next += 1
+        self._link(file, file.path)
+
+    def _link(self, file, path):
+
+        bucket = self._paths.setdefault(path, [])
+        bucket.append(file)
+        if len(bucket) > 1:
+            bucket.sort(key=lambda x: self._order[id(x)])
+        self._node(path, create=True).files[id(file)] = file
+
+    def _unlink(self, file, path):
+
+        bucket = self._paths.get(path)
+        if bucket:
+            bucket[:] = [i for i in bucket if i is not file]
+            if not bucket:
+                del self._paths[path]
+
+        node = self._node(path)
+        if node is not None:
+            node.files.pop(id(file), None)
+
+    def _remove(self, file):
+
+        if self._repeated:
+            self._drop_index()
+        elif self._paths is not None and id(file) in self._order:
+            del self._order[id(file)]
+            self._unlink(file, file.path)
+
+    def _moved(self, file, old):
+        """Called by a :any:`File` when its path is changed."""
+
+        if self._paths is not None and id(file) in self._order:
+            self._unlink(file, old)
+            self._link(file, file.path)
+
+    # Lookups
+
+    def lookup(self, path):
+        """Returns the first :any:`File` with a given `path` or `None`.
+        The `path` is not a pattern, it must be exactly the same."""
+
+        if self._paths is None:
+            self._build_index()
+
+        bucket = self._paths.get(path)
+        return bucket[0] if bucket else None
+
+    def candidates(self, patterns):
+        """Returns files that can match any of given :any:`Pattern`
+        instances, in a list order. Only directories pointed by patterns
+        prefixes are visited."""
+
+        if self._paths is None:
+            self._build_index()
+
+        found = {}
+
+        for p in patterns:
+
+            if p.literal:
+                for file in self._paths.get(p.pattern, ()):
+                    found[id(file)] = file
+                continue
+
+            if not p.prefix and GLOBSTAR in p.segments:
+                return list(self)
+
+            node = self._node(p.prefix)
+            if node is None:
+                continue
+
+            if GLOBSTAR in p.segments or \
+                    len(p.segments) != p.prefix.count(SEP) + 1:
+                found.update((id(i), i) for i in node.walk())
+            else:
+                found.update(node.files)
+
+        return sorted(found.values(), key=lambda x: self._order[id(x)])
+
+    # List methods
+
+    def append(self, file):
+        super().append(file)
+        if self._paths is not None:
+            if id(file) in self._order:
+                self._drop_index()
+            else:
+                self._add(file)
+
+    def extend(self, files):
+        for i in files:
+            self.append(i)
+
+    def __iadd__(self, files):
+        self.extend(files)
+        return self
+
+    def remove(self, file):
+
+        # Files are dicts, so compare identity first, other file can be
+        # equal to the removed one.
+        for index, i in enumerate(self):
+            if i is file:
+                super().__delitem__(index)
+                self._remove(i)
+                return
+
+        super().remove(file)
+        self._drop_index()
+
+    def pop(self, index=-1):
+        file = super().pop(index)
+        self._remove(file)
+        if index not in (-1, len(self)):
+            self._drop_index()
+        return file
+
+    def clear(self):
+        self._detach()
+        super().clear()
+
+    def replace(self, old, new):
+        """Puts a `new` file in place of an `old` one, or appends it if
+        the `old` file is not in a list. Keeps the index up to date."""
+
+        for index, i in enumerate(self):
+            if i is old:
+                break
+        else:
+            self.append(new)
+            return
+
+        super().__setitem__(index, new)
+
+        if self._repeated or self._paths is None or \
+                id(old) not in self._order or id(new) in self._order:
+            self._drop_index()
+            return
+
+        self._unlink(old, old.path)
+        self._order[id(new)] = self._order.pop(id(old))
+        if not any(x is self for x in new._lists):
+            new._lists += (self,)
+        self._link(new, new.path)
+
+    def insert(self, index, file):
+        super().insert(index, file)
+        self._drop_index()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._drop_index()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._drop_index()
+
+    def __imul__(self, value):
+        result = super().__imul__(value)
+        self._drop_index()
+        return result
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._drop_index()
+
+    def reverse(self):
+        super().reverse()
+        self._drop_index()
+
+
 class Rucola:
     """Rucola static site generator.
 
@@ -283,12 +2049,71 @@ class Rucola:
         `pathmatcher`
             Object used to test if a path matches a pattern.
 
+        `jobs (default: 1)`
+            Number of threads used to scan a `source` directory and default
+            number of threads used by :any:`build()` to write files.
+
+        `incremental (default: False)`
+            If `True`, :any:`build()` skips files that did not change since
+            the previous build, see :any:`Manifest`.
+
+        `write (default: 'always')`
+            Default write policy used by :any:`build()`.
+
+        `passthrough (default: 'copy')`
+            Default passthrough strategy used by :any:`build()`.
+
+        `cache_size (default: 32 MB)`
+            Size in bytes of a :any:`ContentCache` shared by all loaded files,
+            available as `self.cache`. Use `0` to read files every time their
+            content is used, `self.cache` is `None` then.
+
+        `profile (default: False)`
+            If `True`, each plugin call made by :any:`use()` and each
+            :any:`build()` is measured and added to `self.stats`, see
+            :any:`PluginStats`. A table with all statistics is logged at
+            the end of every build.
+
+        `sync (default: False)`
+            Default output sync mode used by :any:`build()`.
+
+        `compress`
+            Default :any:`Precompress` used by :any:`build()`.
+
+        `load (default: True)`
+            If `False`, files are not loaded from a `source` directory,
+            use :any:`load()` or :any:`load_async()` later.
+
+        `cache_dir (default: '.rucola-cache')`
+            A directory relative to a `path` working directory, where
+            results of plugins are stored by :any:`cached()`. Available
+            as `self.transform_cache`, see :any:`TransformCache`.
+
     """
 
     def __init__(self, path=None, source=SOURCE_DIR, output=OUTPUT_DIR,
-                 pathmatcher=pathmatch):
+                 pathmatcher=pathmatch, jobs=1, incremental=False,
+                 write=WRITE_ALWAYS, passthrough=PASSTHROUGH_COPY,
+                 cache_size=CACHE_SIZE, profile=False, sync=False,
+                 compress=None, load=True, cache_dir=CACHE_DIR):
 
         self._pathmatch = pathmatcher
+        self.jobs = jobs
+        self.incremental = incremental
+        self.write = write
+        self.passthrough = passthrough
+        self.sync = sync
+        self.compress = compress
+        self.cache = ContentCache(cache_size) if cache_size else None
+        # Files not written by the last build(), because they did not change.
+        self.skipped = []
+        self.profile = profile
+        # List of PluginStats, filled when profile is True.
+        self.stats = []
+        # Path => fingerprinted path, see fingerprint()
+        self.assets = {}
+        self.transform_cache = TransformCache(
+            os.path.abspath(os.path.join(path or '', cache_dir)))
 
         self._metadata = {}
 
@@ -309,13 +2134,10 @@ class Rucola:
             self.output = os.path.join(self.path, output)
 
             if not os.path.exists(self.path) or not os.path.exists(self.source):
-                msg = 'Directory not found, please create it first: ' + path
-                if PYTHON32:
-                    raise IOError(msg)
-                else:
-                    raise FileNotFoundError(msg)
+                raise FileNotFoundError(
+                    'Directory not found, please create it first: ' + path)
 
-            self.files = self._find_files()
+            self.files = self._find_files() if load else []
 
     @property
     def source(self):
@@ -332,6 +2154,21 @@ class Rucola:
         info('Output: ' + path)
         self._output = path
 
+    @property
+    def files(self):
+        """List of :any:`File` instances, see :any:`FileList`. Any list
+        assigned here is converted to a :any:`FileList`."""
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        if not isinstance(value, FileList):
+            value = FileList(value)
+        old = getattr(self, '_files', None)
+        if old is not None and old is not value:
+            old._detach()
+        self._files = value
+
     @property
     def metadata(self):
         return self._metadata
@@ -344,55 +2181,530 @@ class Rucola:
 
     def _find_files(self):
         """Returns list with :any:`File` instances, loaded from
-        `self.source` directory"""
+        `self.source` directory. Directories are scanned by `self.jobs`
+        threads, files are ordered like by `os.walk()`: files of a directory
+        and then its subdirectories."""
 
+        verbose = log.isEnabledFor(logging.DEBUG)
         result = []
 
-        for path, dirs, files in os.walk(self.source, followlinks=True):
-            for f in files:
+        for path, p, st in self._scan_source():
+            if verbose:
+                debug(p)
+            result.append(self._load_file(path, p, st))
 
-                # /home/source/foo/ + file.txt => foo/file.txt
-                p = os.path.relpath(os.path.join(path, f), self.source)
-                # convert \\ to /
-                p = posixpath.join(*p.split(os.sep))
+        return result
 
-                debug(p)
+    def load(self):
+        """Loads all files from a `source` directory again, they replace
+        `self.files`. Returns `self`."""
 
-                result.append(
-                    File(p,
-                         content=ContentReader(os.path.join(path, f)),
-                         global_metadata=self.metadata)
-                )
+        self.files = self._find_files()
+        return self
 
-        return result
+    async def load_async(self, progress=None, batch=256):
+        """Same as :any:`load()`, but a `source` directory is scanned in
+        an executor, `batch` files at a time, so an event loop is not
+        blocked. A `progress(count)` callback (a function or a coroutine
+        function) is called with a number of files loaded so far:
 
-    #
+        >>> app = Rucola('.', load=False)
+        >>> await app.load_async()
 
-    def _build_file(self, file):
-        """Write `content` of :any:`File` instance to
-        `self.output` directory."""
+        `self.files` is replaced only when all files are loaded, so
+        a cancelled loading does not change an app.
+        """
 
-        debug(file.path)
+        loop = asyncio.get_event_loop()
+        scan = self._scan_source()
+        files = []
+
+        def next_batch():
+            return list(itertools.islice(scan, batch))
+
+        while True:
+            items = await loop.run_in_executor(None, next_batch)
+            if not items:
+                break
+            files.extend(self._load_file(*i) for i in items)
+            if progress is not None:
+                await _notify(progress, len(files))
+
+        self.files = files
+        return self
+
+    def _load_file(self, path, relpath, st=None):
+        """Returns a new :any:`File` that reads a content from `path`."""
+
+        return File(relpath,
+                    content=ContentReader(path, self.cache, stat=st),
+                    global_metadata=self.metadata)
 
-        os.makedirs(os.path.join(self.output, os.path.dirname(file.path)), exist_ok=True)
+    def _scan_source(self):
+        """Yields ``(path, relative_path, stat)`` tuples for all files
+        in `self.source` directory, in the `_find_files()` order."""
 
-        if file.has_buffer():
-            shutil.copy(file.get_buffer().path, os.path.join(self.output, file.path))
+        if self.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                for i in self._scan_directory(self.source, pool):
+                    yield i
         else:
+            for i in self._scan_directory(self.source, None):
+                yield i
+
+    def _scan_directory(self, top, pool):
+
+        def scan(path, prefix):
+            """Returns files and subdirectories of `path` directory.
+            If there is a `pool`, subdirectories are scanned at once."""
+
+            files, dirs = [], []
+            try:
+                # Not used as a context manager, it needs Python 3.6.
+                for entry in os.scandir(path):
+                    # Follow links, same as os.walk(followlinks=True)
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    name = prefix + entry.name
+                    if is_dir:
+                        dirs.append((entry.path, name + SEP))
+                    else:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            st = None
+                        files.append((entry.path, name, st))
+            except OSError:
+                pass
+
+            if pool is not None:
+                dirs = [pool.submit(scan, *i) for i in dirs]
+            return files, dirs
+
+        stack = [(top, '')]
+        if pool is not None:
+            stack = [pool.submit(scan, top, '')]
+
+        while stack:
+            item = stack.pop()
+            files, dirs = scan(*item) if pool is None else item.result()
+            for i in files:
+                yield i
+            stack.extend(reversed(dirs))
+
+    #
+
+    def writer(self, write=None, passthrough=None):
+        """Returns an :any:`OutputWriter` for a `self.output` directory,
+        with a `write` policy and a `passthrough` strategy (by default
+        `self.write` and `self.passthrough`). All build paths use it, it
+        can be used to write files in a custom way:
+
+        >>> writer = app.writer()
+        >>> writer.plan(app.files)
+        >>> for file in app.files:
+        >>>     writer.write(file)
+        """
+
+        if write is None:
+            write = self.write
+        if write not in WRITE_POLICIES:
+            raise ValueError('Unknown write policy: ' + repr(write))
+        if passthrough is None:
+            passthrough = self.passthrough
+        if passthrough not in PASSTHROUGH:
+            raise ValueError('Unknown passthrough: ' + repr(passthrough))
+
+        return OutputWriter(self.output, write, PASSTHROUGH[passthrough])
+
+    def _file_state(self, file):
+        """Returns a :any:`Manifest` entry that describes a current input
+        of a `file`, without an output information."""
+
+        state = {'source': None,
+                 'mtime': None,
+                 'size': None,
+                 'hash': None,
+                 'output': file.path}
+
+        reader = file._source
+        if reader is not None:
+            st = reader.stat()
+            state['source'] = reader.path
+            state['mtime'] = st.st_mtime_ns
+            state['size'] = st.st_size
+
+        if not file.has_buffer():
+            state['hash'] = hash_content(file.content)
+
+        return state
+
+    def _depends_state(self, file, groups, known=None, walking=None):
+        """Returns :any:`Manifest` `depends` and `groups` entries of
+        a `file`. Files shared by many files (see :any:`depends()`) are
+        stored once in a `groups` dict. States of other files are stored
+        in a `known` dict, so files that share dependencies do not walk
+        them again."""
+
+        if known is None:
+            known = {}
+        result = known.get(id(file))
+        if result is not None:
+            return result
 
-            if isinstance(file.content, bytes):
-                mode, encoding = 'wb', None
+        # Files being walked, to stop at cycles
+        if walking is None:
+            walking = set()
+        walking.add(id(file))
+        result = self._items_state(file._depends, groups, known, walking)
+        walking.discard(id(file))
+
+        known[id(file)] = result
+        return result
+
+    def _items_state(self, items, groups, known, walking):
+        """Returns a state of files and of tuples of shared files listed
+        in `items`, see :any:`_depends_state()`."""
+
+        state = {}
+        keys = set()
+        for i in items:
+            if type(i) is tuple:
+                if id(i) not in walking:
+                    keys.add(self._group_state(i, groups, known, walking))
+                continue
+            reader = i.get_buffer() if i.has_buffer() else None
+            if reader is not None:
+                st = reader.stat()
+                state[reader.path] = [st.st_mtime_ns, st.st_size]
+            else:
+                state[i.path] = None
+            if i._depends and id(i) not in walking:
+                depends, found = self._depends_state(i, groups, known,
+                                                     walking)
+                state.update(depends)
+                keys.update(found)
+        return state, sorted(keys)
+
+    def _group_state(self, group, groups, known, walking):
+        """Adds a state of a tuple of shared files to `groups`, keyed by
+        its hash, and returns the key."""
+
+        key = known.get(id(group))
+        if key is None:
+            walking.add(id(group))
+            depends, found = self._items_state(group, groups, known, walking)
+            walking.discard(id(group))
+
+            value = {'depends': depends, 'groups': found}
+            key = hash_content(json.dumps(value, sort_keys=True))
+            groups[key] = value
+            known[id(group)] = key
+        return key
+
+    def _build_incremental(self, file, manifest, writer, known=None):
+        """Writes a `file` by a `writer`, but does nothing if a `file`
+        input and its output are the same as recorded in a `manifest`.
+        A `known` dict is shared by a build, see :any:`_depends_state()`."""
+
+        state = self._file_state(file)
+        depends, groups = self._depends_state(file, manifest.groups, known)
+        entry = manifest.files.get(file.path)
+        output = os.path.join(self.output, file.path)
+
+        if entry is not None and \
+                all(entry.get(k) == v for k, v in state.items()):
+            try:
+                st = os.stat(output)
+            except OSError:
+                pass
             else:
-                mode, encoding = 'w', 'utf-8'
+                if entry.get('output_mtime') == st.st_mtime_ns and \
+                        entry.get('output_size') == st.st_size:
+                    entry['depends'] = depends
+                    entry['groups'] = groups
+                    return None
+
+        written = writer.write(file)
+
+        st = os.stat(output)
+        state['output_mtime'] = st.st_mtime_ns
+        state['output_size'] = st.st_size
+        state['depends'] = depends
+        state['groups'] = groups
+        manifest.files[file.path] = state
+        return written
+
+    def _build_timed(self, build, file):
+        """Calls `build(file)` and returns a :any:`BuildResult`."""
+
+        start = time.perf_counter()
+        size = build(file)
+        return BuildResult(file, size is not None, size or 0,
+                           time.perf_counter() - start)
+
+    def _check_paths(self, files):
+        """Raises a :any:`BuildError` if many `files` have the same output
+        path, they would race each other when written by many threads."""
+
+        errors = []
+        paths = {}
+        for f in files:
+            p = os.path.normcase(posixpath.normpath(f.path))
+            if p in paths:
+                errors.append((f, ValueError(
+                    'Output path already used by: ' + paths[p].path)))
+            else:
+                paths[p] = f
+        if errors:
+            raise BuildError(errors)
+
+    def _start_build(self, target, incremental, write, passthrough,
+                     shard=None, shards=None, compress=None):
+        """Prepares an output directory for a build. Returns a list of
+        files to build, a function that builds one file and a :any:`Manifest`
+        or `None`. Built files are given to a `compress`, a :any:`Precompress`
+        or `None`."""
+
+        info('Building: ' + str(target))
+
+        # Create missing output dir
+        os.makedirs(self.output, exist_ok=True)
+
+        files = [target] if isinstance(target, File) else self.find(target)
+
+        if shards is not None:
+            if shard is None or not 0 <= shard < shards:
+                raise ValueError('Shard must be from 0 to {}: {!r}'.format(
+                    shards - 1, shard))
+            files = [i for i in files if shard_of(i.path, shards) == shard]
+
+        if incremental is None:
+            incremental = self.incremental
+
+        writer = self.writer(write, passthrough)
+        writer.plan(files)
+        manifest = None
+        build = writer.write
+        if incremental:
+            manifest = Manifest(os.path.join(self.output, MANIFEST_FILE))
+            build = functools.partial(self._build_incremental,
+                                      manifest=manifest, writer=writer,
+                                      known={})
+
+        if compress:
+            compress.start()
+            write_file = build
+
+            def build(file):
+                size = write_file(file)
+                compress.submit(file, os.path.join(self.output, file.path),
+                                size is not None)
+                return size
+
+        self.skipped = []
+        return files, build, manifest
+
+    def _finish_build(self, files, manifest, sync, shard=None, shards=None,
+                      compress=None, done=True):
+        """Saves a `manifest` after a build and waits for a `compress`. If
+        a build is `done`, also prunes an output directory and writes
+        a shard manifest."""
+
+        errors = []
+        try:
+            if compress:
+                errors = compress.finish(cancel=not done)
+            if done and sync:
+                keep = self.files
+                if shards is not None:
+                    keep = [i for i in keep
+                            if shard_of(i.path, shards) == shard]
+                # Files built now are kept, even if they are not (or no
+                # longer) in self.files.
+                removed = self.prune_output(list(files) + list(keep))
+                if manifest is not None:
+                    for p in removed:
+                        manifest.files.pop(p, None)
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+        if not done:
+            return
+        if errors:
+            raise BuildError(errors)
+
+        if shards is not None:
+            write_json(os.path.join(self.output, SHARD_FILE),
+                       {'shard': shard, 'shards': shards,
+                        'files': [i.path for i in files]})
+
+        if self.skipped:
+            info('Skipped {} of {} unchanged files'.format(
+                len(self.skipped), len(files)))
+
+    def _build_parallel(self, files, jobs, build):
+        """Builds `files` using a pool of `jobs` threads and a `build`
+        function. Yields a :any:`BuildResult` for each file, in the same
+        order as `files`. Only a few files are built ahead of a consumer.
+        All errors are collected and raised together as a :any:`BuildError`
+        at the end."""
+
+        self._check_paths(files)
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+
+            files = iter(files)
+            pending = deque()
+
+            def submit():
+                for f in files:
+                    pending.append(
+                        (f, pool.submit(self._build_timed, build, f)))
+                    return
+
+            for i in range(jobs * 2):
+                submit()
+
+            while pending:
+                f, future = pending.popleft()
+                submit()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append((f, e))
+                else:
+                    yield result
+
+        if errors:
+            raise BuildError(errors)
+
+    def ibuild(self, target='**/*', jobs=None, incremental=None, write=None,
+               passthrough=None, shard=None, shards=None, sync=None,
+               compress=None):
+        """Same as :any:`build()`, but it is a generator that yields
+        a :any:`BuildResult` as soon as each file is written. Files can be
+        uploaded, logged or removed from an app while a build is running:
 
-            with open(os.path.join(self.output, file.path), mode, encoding=encoding) as f:
-                f.write(file.content)
+        >>> for result in app.ibuild('**/*.jpg', jobs=8):
+        >>>     print(result.file.path, result.size, result.time)
+        >>>     app.files.remove(result.file)
 
-    def build(self, target='**/*'):
+        Results are yielded in the same order as files are returned by
+        :any:`find()`, even when they are written by many threads.
+        """
+
+        if compress is None:
+            compress = self.compress
+        files, build, manifest = self._start_build(
+            target, incremental, write, passthrough, shard, shards, compress)
+
+        if jobs is None:
+            jobs = self.jobs
+        if sync is None:
+            sync = self.sync
+
+        if jobs > 1 and len(files) > 1:
+            results = self._build_parallel(files, jobs, build)
+        else:
+            results = (self._build_timed(build, f) for f in files)
+
+        try:
+            for result in results:
+                if not result.written:
+                    self.skipped.append(result.file)
+                yield result
+        except BaseException:
+            self._finish_build(files, manifest, sync, compress=compress,
+                               done=False)
+            raise
+        self._finish_build(files, manifest, sync, shard, shards, compress)
+
+    def build(self, target='**/*', jobs=None, incremental=None, write=None,
+              passthrough=None, shard=None, shards=None, sync=None,
+              compress=None):
         """Find all :any:`File` instances that matches a `target` pattern and write their
         `content` to `self.output` directory. Returns list of built :any:`File` instances.
         Pattern supports glob syntax, just like :any:`find()` method.
 
+        Files are written by `jobs` threads, by default `self.jobs`. When
+        more than one thread is used, all files are built even if some of
+        them fail, then a :any:`BuildError` with all errors is raised.
+        Files with the same output path are reported as errors before
+        anything is written.
+
+        If `incremental` is `True` (by default `self.incremental`), files
+        that did not change since the previous incremental build are not
+        written again. Changes are tracked in a :any:`Manifest` file
+        stored in an output directory, use :any:`clear_output()` to force
+        a full build.
+
+        A `write` policy (by default `self.write`) decides if an existing
+        output file is replaced:
+
+            `'always'`
+                Always write a file.
+
+            `'if-changed'`
+                Write a file only if its content differs from an existing
+                output. Sizes are compared first, then a content.
+
+            `'mtime'`
+                Copy a source file only if an output has a different size
+                or it is older than a source. Files with a content set in
+                memory are handled like with `'if-changed'`.
+
+        Files that were not written are listed in `self.skipped`. See
+        :any:`ibuild()` to get results while files are still being written.
+
+        Files with a content that was not changed (see
+        :any:`File.has_buffer()`) are written using a `passthrough`
+        strategy (by default `self.passthrough`):
+
+            `'copy'`
+                Copy data and permission bits, like `shutil.copy()`.
+
+            `'hardlink'`, `'symlink'`
+                Link an output file to a source file. Do not edit such
+                output files, changes will be visible in the source too.
+
+            `'reflink'`
+                Clone a file using a copy-on-write filesystem (btrfs, xfs).
+
+            `'auto'`
+                Try a reflink, a kernel side copy and a normal copy, and use
+                the first one that works. Outputs never share data with
+                sources, unlike links.
+
+        Strategies other than `'copy'` and `'auto'` raise an `OSError` when
+        they are not supported by a filesystem.
+
+        A build can be split between `shards` processes or machines, each
+        one builds only files of its `shard` (from `0` to `shards - 1`),
+        chosen by a hash of an output path (see :any:`shard_of()`). Only
+        these files are read. A list of them is written to a shard manifest
+        in an output directory, use :any:`merge_shards()` to combine all
+        output directories. Build all files of a shard with one call:
+
+        >>> app.output = 'build-{}'.format(shard)
+        >>> app.build(shard=shard, shards=4)
+
+        If `sync` is `True` (by default `self.sync`), files in an output
+        directory that are not outputs of any file in `self.files` are
+        removed after a build, see :any:`prune_output()`. Together with
+        an incremental build or a `'if-changed'` write policy it replaces
+        :any:`clear_output()`, only changed files are written and a site
+        is never empty.
+
+        A `compress` (by default `self.compress`) is a :any:`Precompress`
+        that writes compressed sidecars of built files, use `False` to
+        disable it.
+
         Also parameter `target` can be a :any:`File` instance:
 
         >>> app = Rucola()
@@ -409,21 +2721,97 @@ class Rucola:
 
         """
 
-        info('Building: ' + str(target))
+        def build():
+            return [i.file for i in self.ibuild(target, jobs, incremental,
+                                                write, passthrough, shard,
+                                                shards, sync, compress)]
 
-        # Create missing output dir
-        os.makedirs(self.output, exist_ok=True)
+        if not self.profile:
+            return build()
 
-        if isinstance(target, File):
-            self._build_file(target)
-            return [target]
+        result = self._measure('build({})'.format(target), build)
+        info('Statistics:\n' + self.format_stats())
+        return result
 
-        else:
-            result = []
-            for file in self.find(target):
-                self._build_file(file)
-                result.append(file)
-            return result
+    async def build_async(self, target='**/*', concurrency=None,
+                          progress=None, executor=None, incremental=None,
+                          write=None, passthrough=None, sync=None,
+                          compress=None):
+        """Same as :any:`build()`, but files are written in an `executor`
+        (by default an event loop executor), so an event loop is not
+        blocked. At most `concurrency` files (by default `self.jobs`) are
+        written at the same time. A `progress(result)` callback (a function
+        or a coroutine function) is called with a :any:`BuildResult` after
+        each file is written:
+
+        >>> async def progress(result):
+        >>>     await websocket.send_str(result.file.path)
+        >>> await app.build_async(concurrency=8, progress=progress)
+
+        Errors are collected and raised together as a :any:`BuildError`.
+        A build can be cancelled, files that are already being written are
+        finished in the background.
+        """
+
+        loop = asyncio.get_event_loop()
+        if concurrency is None:
+            concurrency = self.jobs
+        if sync is None:
+            sync = self.sync
+        if compress is None:
+            compress = self.compress
+        if compress:
+            # In this thread, not in an executor, see _process_pool()
+            compress.start()
+
+        files, build, manifest = await loop.run_in_executor(
+            executor, functools.partial(self._start_build, target,
+                                        incremental, write, passthrough,
+                                        compress=compress))
+
+        results = [None] * len(files)
+        errors = []
+        items = iter(enumerate(files))
+
+        async def worker():
+            for i, file in items:
+                try:
+                    result = await loop.run_in_executor(
+                        executor, self._build_timed, build, file)
+                except asyncio.CancelledError:
+                    # An Exception subclass before Python 3.8
+                    raise
+                except Exception as e:
+                    errors.append((file, e))
+                    continue
+                results[i] = result
+                if not result.written:
+                    self.skipped.append(file)
+                if progress is not None:
+                    await _notify(progress, result)
+
+        done = False
+        try:
+            self._check_paths(files)
+            await asyncio.gather(*[worker() for i in range(
+                max(1, min(concurrency, len(files))))])
+            done = not errors
+        finally:
+            await loop.run_in_executor(
+                executor, functools.partial(self._finish_build, files,
+                                            manifest, sync, compress=compress,
+                                            done=done))
+
+        if errors:
+            raise BuildError(errors)
+        return [i.file for i in results]
+
+    def _matcher(self, pattern):
+        """Returns a function that tests if a path matches a `pattern`."""
+
+        if self._pathmatch is pathmatch:
+            return compile_pattern(pattern).match
+        return lambda path: self._pathmatch(path, pattern)
 
     def get(self, path):
         """Returns a :any:`File` instance that matches a given `path` or
@@ -435,9 +2823,11 @@ class Rucola:
         >>> file = app.get('path/to/file')
         """
 
-        for file in self.files:
-            if self._pathmatch(file.path, path):
-                return file
+        if self._pathmatch is pathmatch and not has_magic(path):
+            return self.files.lookup(path)
+
+        for file in self.ifind(path):
+            return file
         return None
 
     def find(self, *patterns):
@@ -468,9 +2858,17 @@ class Rucola:
         from a :any:`Rucola` app in a loop.
         """
 
-        for file in self.files:
-            for p in patterns:
-                if self._pathmatch(file.path, p):
+        matchers = [self._matcher(p) for p in patterns]
+
+        if self._pathmatch is pathmatch:
+            files = self.files.candidates(
+                [compile_pattern(p) for p in patterns])
+        else:
+            files = self.files
+
+        for file in files:
+            for match in matchers:
+                if match(file.path):
                     yield file
                     break
 
@@ -487,6 +2885,135 @@ class Rucola:
             return True
         return False
 
+    def fingerprint(self, *patterns, length=8, manifest='assets.json'):
+        """Adds a hash of a content to paths of files that match `patterns`,
+        for example ``css/app.css`` becomes ``css/app.3f9a1c2b.css``, so
+        they can be cached forever. Returns a dict that maps old paths to
+        new ones, see also :any:`asset_url()`:
+
+        >>> app.fingerprint('**/*.css', '**/*.js')
+        {'css/app.css': 'css/app.3f9a1c2b.css'}
+
+        A hash has `length` characters. Source files are hashed in chunks
+        by `self.jobs` threads, never loaded into memory, and hashes are
+        reused if a size and a modification time of a source did not
+        change since the last call. All mappings are also written as JSON
+        to a `manifest` file, which is added to `self.files` (use `None`
+        to skip it).
+
+        Files fingerprinted by an earlier call and a `manifest` file are
+        skipped, so it can be called again for other patterns.
+        """
+
+        path = os.path.join(self.output, FINGERPRINT_FILE)
+        try:
+            with open(path, encoding='utf-8') as f:
+                known = json.load(f)['files']
+        except (OSError, ValueError, KeyError, TypeError):
+            known = {}
+        hashes = {}
+
+        def digest(file):
+            if not file.has_buffer() or file.get_buffer().offset:
+                return hash_content(encode_content(file.content))
+            reader = file.get_buffer()
+            st = reader.stat()
+            state = [st.st_mtime_ns, st.st_size]
+            item = known.get(reader.path)
+            if item is not None and item[:2] == state:
+                h = item[2]
+            else:
+                h = hash_file(reader.path)
+            hashes[reader.path] = state + [h]
+            return h
+
+        done = set(self.assets.values())
+        files = [i for i in self.find(*patterns)
+                 if i.path not in done and i.path != manifest]
+        if self.jobs > 1 and len(files) > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                digests = list(pool.map(digest, files))
+        else:
+            digests = [digest(i) for i in files]
+
+        result = {}
+        for file, h in zip(files, digests):
+            root, ext = posixpath.splitext(file.path)
+            result[file.path] = '{}.{}{}'.format(root, h[:length], ext)
+            file.path = result[file.path]
+        self.assets.update(result)
+
+        known.update(hashes)
+        os.makedirs(self.output, exist_ok=True)
+        write_json(path, {'files': known})
+
+        if manifest:
+            content = json.dumps(self.assets, indent=2, sort_keys=True)
+            file = self.get(manifest)
+            if file is None:
+                self.create(manifest, content=content)
+            else:
+                file.content = content
+
+        return result
+
+    def asset_url(self, path):
+        """Returns a fingerprinted path of a file that was at `path`, see
+        :any:`fingerprint()`. Other files in `self.files` keep their path.
+        Raises a `KeyError` for unknown files. Use it in templates:
+
+        >>> app.asset_url('css/app.css')
+        'css/app.3f9a1c2b.css'
+        """
+
+        if path in self.assets:
+            return self.assets[path]
+        if self.get(path) is None:
+            raise KeyError('Unknown asset: ' + path)
+        return path
+
+    def prune_output(self, files=None):
+        """Removes files from a `self.output` directory that are not outputs
+        of `files` (by default `self.files`), and directories that became
+        empty. Manifest files and compressed sidecars of kept files (see
+        :any:`Precompress`) are kept too. Returns list of removed paths,
+        relative to an output directory."""
+
+        if files is None:
+            files = self.files
+        keep = set(os.path.normcase(posixpath.normpath(i.path))
+                   for i in files)
+        keep.update((MANIFEST_FILE, SHARD_FILE, FINGERPRINT_FILE))
+        removed = []
+
+        def prune(path, prefix):
+            """Returns True if a directory is empty after pruning."""
+
+            empty = True
+            for entry in os.scandir(path):
+                p = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if prune(entry.path, p + SEP):
+                        os.rmdir(entry.path)
+                        debug('Removed directory: ' + p)
+                    else:
+                        empty = False
+                elif os.path.normcase(p) in keep or any(
+                        p.endswith(i) and os.path.normcase(p[:-len(i)]) in keep
+                        for i in COMPRESSION_FORMATS.values()):
+                    empty = False
+                else:
+                    os.remove(entry.path)
+                    removed.append(p)
+                    debug('Removed: ' + p)
+            return empty
+
+        if os.path.isdir(self.output):
+            prune(self.output, '')
+        if removed:
+            info('Removed {} stale files'.format(len(removed)))
+        return removed
+
     def create(self, path, **metadata):
         """Returns a new :any:`File` instance with given `path` and `content`.
         It is added to `self.files` list. If the :any:`File` with a given `path`
@@ -523,10 +3050,500 @@ class Rucola:
         >>> app.use(foo)
         >>> app.output
         'new/output'
+
+        A :any:`MapPlugin` instance is a per-file plugin, it is called by
+        :any:`map()`:
+
+        >>> app.use(Upper())
         """
 
         for i in plugins:
-            if callable(i):
+            func = i
+            if isinstance(i, MapPlugin):
+                func = functools.partial(Rucola.map, pattern=i.pattern,
+                                         transform=i.transform, jobs=i.jobs)
+            if callable(func):
                 info('Using plugin: ' + repr(i))
-                i(self)
+                if self.profile:
+                    self._measure(repr(i), self._track, func)
+                else:
+                    self._track(func)
         return self
+
+    def _file_data(self, file):
+        """Returns a dict with a path, a content and metadata of a `file`,
+        that can be sent to other process."""
+
+        data = dict(file.items())
+        content = data['content']
+        if isinstance(content, ContentReader):
+            # A cache is not shared between processes.
+            data['content'] = ContentReader(content.path,
+                                            binary=content.binary,
+                                            stat=content._stat,
+                                            offset=content.offset)
+        elif callable(content):
+            data['content'] = file.content
+        return data
+
+    def map(self, pattern, transform, jobs=None):
+        """Calls `transform(data)` for each :any:`File` that matches
+        a `pattern`, in a pool of `jobs` processes (by default a number
+        of CPUs), so CPU bound plugins use all cores. Returns `self`.
+
+        A `data` is a dict with a `path`, a `content` and metadata of
+        a file, without global metadata. A `transform` returns a dict with
+        changed keys, which are set on a file, or `None` to remove
+        a file from `self.files`:
+
+        >>> def render(data):
+        >>>     data['content'] = markdown.markdown(data['content'])
+        >>>     data['path'] = data['path'][:-3] + '.html'
+        >>>     return data
+        >>> app.map('**/*.md', render)
+
+        A `transform` must be a pure function that can be pickled, for
+        example a module level function. Files are read in worker
+        processes and a content returned unchanged is not sent back, so
+        a file is still written by a passthrough strategy.
+        """
+
+        files = self.find(pattern)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+
+        data = [self._file_data(i) for i in files]
+        func = functools.partial(_map_file, transform)
+
+        if jobs > 1 and len(files) > 1:
+            jobs = min(jobs, len(files))
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(
+                    func, data, chunksize=max(1, len(data) // (jobs * 4))))
+        else:
+            results = [func(i) for i in data]
+
+        for file, result in zip(files, results):
+            if result is None:
+                self.files.remove(file)
+            else:
+                file.update(result)
+        return self
+
+    def _track(self, plugin):
+        """Calls a `plugin` and records dependencies of files it changed
+        or created, see :any:`depends()`."""
+
+        tracker = _Tracker()
+        _trackers.append(tracker)
+        try:
+            return plugin(self)
+        finally:
+            _trackers.remove(tracker)
+
+            writes = tracker.writes
+            shared = tuple(i for i in tracker.shared or ()
+                           if id(i) not in writes)
+            for file, reads in writes.values():
+                reads = [i for i in reads if id(i) not in writes]
+                if reads:
+                    self.depends(file, reads)
+                if shared:
+                    if not file._depends:
+                        file._depends = []
+                    file._depends.append(shared)
+
+    def depends(self, file, on=None):
+        """Records that an output of a `file` is made from other :any:`File`
+        instances listed in `on`. Returns list of all files that a `file`
+        depends on directly.
+
+        >>> layout = app.get('layouts/post.html')
+        >>> for file in app.find('posts/*.md'):
+        >>>     app.depends(file, on=[layout])
+
+        Plugins called by :any:`use()` are tracked automatically: a file
+        whose `content` was set or which was created by a plugin depends
+        on files whose `content` was read since the plugin set a previous
+        one, and on files read before the plugin set the first one (like
+        a layout read before a loop), except files that the plugin changed
+        too. Files read before the first one are stored once and shared.
+
+        Incremental builds store dependencies in a :any:`Manifest`, so
+        :any:`dirty()` finds files affected by a changed layout. Also
+        :any:`watch()` reloads files that depend on changed sources.
+        """
+
+        if on:
+            if not file._depends:
+                file._depends = []
+            items = file._depends
+            known = set(id(i) for i in items)
+            known.add(id(file))
+            for i in on:
+                if id(i) not in known:
+                    known.add(id(i))
+                    items.append(i)
+
+        result = []
+        seen = {id(file)}
+        for i in _depends_of(file):
+            if id(i) not in seen:
+                seen.add(id(i))
+                result.append(i)
+        return result
+
+    def _all_depends(self, file):
+        """Returns list of files that a `file` depends on, directly or
+        through other files."""
+
+        result = []
+        seen = {id(file)}
+        stack = [file]
+        while stack:
+            for i in _depends_of(stack.pop()):
+                if id(i) not in seen:
+                    seen.add(id(i))
+                    result.append(i)
+                    stack.append(i)
+        return result
+
+    def dirty(self):
+        """Returns list of files from `self.files` that must be built again
+        since the last incremental build: files whose source changed or
+        whose output depends on a changed source, see :any:`depends()`.
+        Files not built by that build are returned too. Call it before
+        plugins, to run them only for what changed:
+
+        >>> app = Rucola('.', incremental=True)
+        >>> files = app.dirty()
+        """
+
+        manifest = Manifest(os.path.join(self.output, MANIFEST_FILE))
+
+        # Source path => [mtime, size] or None if it is missing
+        current = {}
+        for file in self.files:
+            if file.has_buffer():
+                st = file.get_buffer().stat()
+                current[file.get_buffer().path] = [st.st_mtime_ns, st.st_size]
+
+        def stat(path):
+            if path not in current:
+                try:
+                    st = os.stat(path)
+                    current[path] = [st.st_mtime_ns, st.st_size]
+                except OSError:
+                    current[path] = None
+            return current[path]
+
+        # Output path => True if it must be built again
+        changed = {}
+        # Group key => True if shared dependencies changed
+        groups = {}
+
+        def check_depends(item):
+            return any(check(k) if v is None else stat(k) != v
+                       for k, v in item.get('depends', {}).items()) or \
+                any(check_group(k) for k in item.get('groups', ()))
+
+        def check_group(key):
+            if key not in groups:
+                # Stops a dependency cycle
+                groups[key] = False
+                group = manifest.groups.get(key)
+                groups[key] = group is None or check_depends(group)
+            return groups[key]
+
+        def check(output):
+            if output not in changed:
+                # Stops a dependency cycle
+                changed[output] = False
+                entry = manifest.files.get(output)
+                changed[output] = entry is None or \
+                    entry['source'] is not None and \
+                    stat(entry['source']) != [entry['mtime'], entry['size']] or \
+                    check_depends(entry)
+            return changed[output]
+
+        built = set()
+        sources = set()
+        for output, entry in manifest.files.items():
+            built.add(entry['source'])
+            if check(output):
+                sources.add(entry['source'])
+
+        return [i for i in self.files
+                if i.source is None or i.source not in built or
+                i.source in sources]
+
+    def cached(self, plugin_id, version, metadata=None):
+        """Returns a decorator for a function `func(file)` that stores its
+        results in `self.transform_cache`. When a result for the same
+        input is stored, the function is not called at all. It survives
+        between builds, so expensive plugins run only for changed files:
+
+        >>> @app.cached('markdown', '2.1')
+        >>> def render(file):
+        >>>     return markdown.markdown(file.content)
+        >>> for file in app.find('**/*.md'):
+        >>>     file.content = render(file)
+
+        A result is keyed by a `plugin_id`, a `version`, a file `content`
+        and its metadata, so change a `version` when a function output
+        changes. Only `metadata` keys are used if given (global metadata
+        too), otherwise all keys set on a file. Results must be picklable.
+        """
+
+        cache = self.transform_cache
+        missing = object()
+
+        def key(file):
+            if metadata is None:
+                values = dict((k, v) for k, v in file.items()
+                              if k not in File.KEYS)
+            else:
+                values = {}
+                for k in metadata:
+                    try:
+                        values[k] = file[k]
+                    except KeyError:
+                        values[k] = None
+            return cache.key(plugin_id, str(version),
+                             encode_content(file.content),
+                             json.dumps(values, sort_keys=True, default=repr))
+
+        def decorator(func):
+
+            @functools.wraps(func)
+            def wrapper(file):
+                k = key(file)
+                result = cache.get(k, missing)
+                if result is missing:
+                    result = func(file)
+                    cache.set(k, result)
+                return result
+
+            wrapper.key = key
+            return wrapper
+
+        return decorator
+
+    def _measure(self, name, func, *args):
+        """Calls `func(*args)` and adds its :any:`PluginStats` to
+        `self.stats`. Returns a `func` result."""
+
+        before = list(self.files)
+        read = ContentReader.bytes_read
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args)
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            peak = None
+            if tracing:
+                peak = max(0, tracemalloc.get_traced_memory()[1] - memory)
+
+            old = set(id(i) for i in before)
+            new = set(id(i) for i in self.files)
+
+            self.stats.append(PluginStats(
+                name, wall, cpu, peak,
+                added=len(new - old),
+                removed=len(old - new),
+                read=ContentReader.bytes_read - read))
+
+    def format_stats(self):
+        """Returns `self.stats` formatted as a text table."""
+
+        def size(x):
+            if x is None:
+                return '-'
+            if x < 1024:
+                return '{} B'.format(x)
+            for unit in ('kB', 'MB'):
+                x /= 1024
+                if x < 1024:
+                    return '{:.1f} {}'.format(x, unit)
+            x /= 1024
+            return '{:.1f} GB'.format(x)
+
+        lines = ['{:<32} {:>9} {:>9} {:>10} {:>7} {:>7} {:>10}'.format(
+            'plugin', 'wall', 'cpu', 'memory', 'added', 'removed', 'read')]
+
+        for i in self.stats:
+            name = i.name if len(i.name) <= 32 else i.name[:29] + '...'
+            lines.append(
+                '{:<32} {:>8.3f}s {:>8.3f}s {:>10} {:>7} {:>7} {:>10}'.format(
+                    name, i.wall, i.cpu, size(i.memory), i.added, i.removed,
+                    size(i.read)))
+
+        return '\n'.join(lines)
+
+    def watch(self, callback, interval=1.0, depends=None):
+        """Watches a `source` directory and calls `callback(app, files)`
+        when files are changed, added or removed. It runs until a `callback`
+        returns `False` or until it is interrupted by Ctrl+C.
+
+        The `callback` is called at once with all files, and after that
+        with new :any:`File` instances loaded only for changed and added
+        source files. These instances replace the old ones in `self.files`,
+        files removed from a source directory are removed from `self.files`.
+        Files created by plugins that depend on changed sources (see
+        :any:`depends()`) are given too, after loaded ones, so a `callback`
+        can make them again. So a `callback` can run plugins and build only
+        what was changed:
+
+        >>> def rebuild(app, files):
+        >>>     for file in files:
+        >>>         file.content = file.content.upper()
+        >>>         app.build(file)
+        >>> app = Rucola('.')
+        >>> app.watch(rebuild)
+
+        Files are matched with source files by :any:`File.source`, so
+        it can be called after plugins changed their content.
+
+        Parameters:
+
+            `interval (default: 1.0)`
+                Seconds between scans of a `source` directory.
+
+            `depends`
+                Dict that maps patterns to patterns (or lists of them) of
+                source files that must be rebuilt too, when a matching
+                source file changes. For example rebuild all pages when
+                a layout changes: ``{'layouts/*': '**/*.md'}``. Files
+                that depend on changed sources (see :any:`depends()`) are
+                reloaded without any rules.
+
+        Exceptions raised by a `callback` are logged and the watching
+        continues, so a broken file can be fixed without a restart.
+        """
+
+        if self.source is None:
+            raise ValueError('Nothing to watch, there is no source directory')
+
+        rules = []
+        for pattern, targets in (depends or {}).items():
+            if isinstance(targets, str):
+                targets = [targets]
+            rules.append((compile_pattern(pattern),
+                          [compile_pattern(i) for i in targets]))
+
+        # Source path => File loaded from it
+        sources = {}
+        for file in self.files:
+            if file.source is not None:
+                p = os.path.relpath(file.source, self.source)
+                sources[SEP.join(p.split(os.sep))] = file
+
+        def key(st):
+            return None if st is None else (st.st_mtime_ns, st.st_size)
+
+        def scan():
+            return OrderedDict((p, (path, st))
+                               for path, p, st in self._scan_source())
+
+        def call(files):
+            try:
+                return callback(self, files) is not False
+            except Exception:
+                log.exception('Watch callback failed')
+                return True
+
+        info('Watching: ' + self.source)
+        state = scan()
+
+        try:
+            if not call(list(self.files)):
+                return
+
+            while True:
+                time.sleep(interval)
+
+                current = scan()
+                changed = [p for p, (path, st) in current.items()
+                           if p not in state or
+                           key(state[p][1]) != key(st)]
+                removed = [p for p in state if p not in current]
+                paths = set(current[p][0] for p in changed)
+                paths.update(state[p][0] for p in removed)
+                state = current
+
+                if not changed and not removed:
+                    continue
+
+                dirty = set(changed)
+                for pattern, targets in rules:
+                    if any(pattern.match(p) for p in changed + removed):
+                        dirty.update(p for p in current
+                                     if any(t.match(p) for t in targets))
+
+                # Files made from changed sources, see depends()
+                for p, file in sources.items():
+                    if p not in dirty and any(
+                            i.source in paths for i in self._all_depends(file)):
+                        dirty.add(p)
+                generated = [file for file in self.files
+                             if file.source is None and file._depends and any(
+                                 i.source in paths
+                                 for i in self._all_depends(file))]
+
+                for p in removed:
+                    info('Removed: ' + p)
+                    file = sources.pop(p, None)
+                    if file is not None:
+                        try:
+                            self.files.remove(file)
+                        except ValueError:
+                            pass
+
+                files = []
+                # id(old file) => File loaded again
+                replaced = {}
+                for p, (path, st) in current.items():
+                    if p in dirty:
+                        info('Changed: ' + p)
+                        file = self._load_file(path, p, st)
+                        old = sources.get(p)
+                        if old is not None:
+                            replaced[id(old)] = file
+                        self.files.replace(old, file)
+                        sources[p] = file
+                        files.append(file)
+
+                # Dependencies point to loaded files, not to the old ones
+                if replaced:
+                    # id(old tuple) => (old tuple, new tuple), see depends()
+                    shared = {}
+                    for file in self.files:
+                        if not file._depends:
+                            continue
+                        items = []
+                        for i in file._depends:
+                            if type(i) is tuple:
+                                if id(i) not in shared:
+                                    shared[id(i)] = (i, tuple(
+                                        replaced.get(id(x), x) for x in i))
+                                items.append(shared[id(i)][1])
+                            else:
+                                items.append(replaced.get(id(i), i))
+                        file._depends = items
+
+                for file in generated:
+                    info('Outdated: ' + file.path)
+                files.extend(generated)
+
+                if not call(files):
+                    return
+
+        except KeyboardInterrupt:
+            info('Watching stopped')
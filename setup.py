@@ -36,6 +36,7 @@ setup(
     url="https://github.com/lecnim/rucola",
 
     py_modules=['rucola'],
+    python_requires='>=3.5',
     include_package_data=True,
     zip_safe=False,
 
@@ -1,12 +1,82 @@
 import os.path
 import types
-
-from rucola import Rucola, File, SOURCE_DIR, OUTPUT_DIR, pathmatch, PYTHON32
+import random
+import time
+import fnmatch
+import tracemalloc
+import pickle
+import shutil
+import asyncio
+import gzip
+import zlib
+import json
+import copy
+import locale
+
+import rucola
+from rucola import Rucola, File, SOURCE_DIR, OUTPUT_DIR, pathmatch
+from rucola import BuildError, BuildResult, MANIFEST_FILE
+from rucola import Pattern, compile_pattern, has_magic, FileList
+from rucola import ContentCache, ContentReader, TransformCache
+from rucola import SHARD_FILE, shard_of, merge_shards
+from rucola import diff_dirs, compare_dirs, hash_file, OutputWriter
+from rucola import Precompress, compress_file
+from rucola import MapPlugin
+from benchmarks import generate_site, compare, measure
 from tests import BaseTest
 
 join = os.path.join
 
 
+def old_pathmatch(path, pattern):
+    """The first pathmatch() implementation, used as a reference."""
+
+    a, b = path.split('/'), pattern.split('/')
+    b_set = None
+
+    while True:
+
+        if not a and not b:
+            return True
+
+        if not a or (not b and not b_set == '**'):
+            return False
+
+        a_set = a.pop(0)
+
+        if b_set != '**':
+            b_set = b.pop(0)
+
+        if b_set == '**' and b:
+
+            a = a[-len(b):]
+            b_set = b.pop(0)
+            if a: a_set = a.pop(0)
+
+        if has_magic(b_set):
+            if not fnmatch.fnmatch(a_set, b_set):
+                return False
+        elif a_set != b_set:
+            return False
+
+
+def upper_transform(data):
+    """Per-file plugin used by map() tests, must be picklable."""
+
+    if data['content'] == 'banana':
+        return None
+    if data['path'].endswith('.md'):
+        data['content'] = data['content'].upper()
+        data['pid'] = os.getpid()
+    return data
+
+
+class UpperPlugin(MapPlugin):
+    pattern = 'posts/*'
+    transform = staticmethod(upper_transform)
+    jobs = 1
+
+
 class TestPathname(BaseTest):
     
     def test_basic(self):
@@ -144,6 +214,43 @@ class TestPathname(BaseTest):
         self.assertTrue(pathmatch('foo/world.txt', p))
 
 
+class TestPattern(BaseTest):
+    """compile_pattern()"""
+
+    def test_cache(self):
+        self.assertIs(compile_pattern('a/*.md'), compile_pattern('a/*.md'))
+        self.assertIsInstance(compile_pattern('a/*.md'), Pattern)
+
+    def test_prefix(self):
+
+        self.assertEqual(compile_pattern('posts/**/*.md').prefix, 'posts/')
+        self.assertEqual(compile_pattern('a/b/c').prefix, 'a/b/')
+        self.assertEqual(compile_pattern('a/*/c').prefix, 'a/')
+        self.assertEqual(compile_pattern('**/*.md').prefix, '')
+        self.assertEqual(compile_pattern('index.md').prefix, '')
+
+    def test_literal(self):
+        self.assertTrue(compile_pattern('a/b.md').literal)
+        self.assertFalse(compile_pattern('a/*.md').literal)
+
+    def test_same_as_old_pathmatch(self):
+
+        segments = ['a', 'b', 'ab', '', '*', '**', '?', 'a*', '*.py',
+                    '[ab]', '[!a]', 'x.py']
+        names = ['a', 'b', 'ab', '', 'x.py', 'ba', 'c']
+        rand = random.Random(0)
+
+        for i in range(3000):
+            pattern = '/'.join(rand.choice(segments)
+                               for j in range(rand.randint(1, 4)))
+            path = '/'.join(rand.choice(names)
+                            for j in range(rand.randint(1, 5)))
+
+            self.assertEqual(old_pathmatch(path, pattern),
+                             pathmatch(path, pattern),
+                             msg='{} {}'.format(path, pattern))
+
+
 class TestFile(BaseTest):
     """File"""
 
@@ -197,6 +304,447 @@ class TestFile(BaseTest):
         with self.assertRaises(KeyError):
             f['notfound']
 
+    def test_slots(self):
+
+        f = File('foo', 'bar')
+
+        self.assertFalse(hasattr(f, '__dict__'))
+        self.assertEqual(dict.__len__(f), 0)
+        self.assertIs(f.path, File(''.join(['f', 'oo'])).path)
+
+    def test_dict_api(self):
+
+        f = File('foo', 'bar')
+        f.update({'fruit': 'banana'}, animal='cat')
+
+        self.assertIn('path', f)
+        self.assertIn('fruit', f)
+        self.assertNotIn('color', f)
+        self.assertEqual(len(f), 4)
+        self.assertEqual(set(f), {'path', 'content', 'fruit', 'animal'})
+        self.assertEqual(dict(f), {'path': 'foo', 'content': 'bar',
+                                   'fruit': 'banana', 'animal': 'cat'})
+        self.assertEqual({**f}, dict(f))
+        self.assertEqual(f.get('content'), 'bar')
+        self.assertEqual(f.pop('fruit'), 'banana')
+
+        with self.assertRaises(KeyError):
+            del f['path']
+
+    def test_source(self):
+
+        self.create_file('a.txt', 'apple')
+        f = File('a.txt', ContentReader(os.path.abspath('a.txt')))
+        f.content = 'APPLE'
+
+        self.assertEqual(f.source, os.path.abspath('a.txt'))
+        self.assertIsNone(File('b.txt', 'banana').source)
+
+    def test_pickle(self):
+
+        f = File('foo', 'bar', {'animal': 'dog'})
+        f['fruit'] = 'banana'
+
+        for i in (pickle.loads(pickle.dumps(f)), copy.copy(f)):
+            self.assertIsInstance(i, File)
+            self.assertEqual(i, f)
+            self.assertEqual(i['animal'], 'dog')
+
+
+class TestContentCache(BaseTest):
+    """ContentCache"""
+
+    def test_read(self):
+
+        self.create_file('a.txt', 'apple')
+        cache = ContentCache()
+        file = File('a.txt', content=ContentReader('a.txt', cache))
+
+        self.assertEqual(file.content, 'apple')
+        self.assertEqual(file.content, 'apple')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.used, 5)
+
+    def test_changed_file(self):
+
+        self.create_file('a.txt', 'apple')
+        cache = ContentCache()
+        reader = ContentReader('a.txt', cache)
+        reader()
+
+        self.create_file('a.txt', 'avocado')
+
+        self.assertEqual(reader(), 'avocado')
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.used, 7)
+
+    def test_eviction(self):
+
+        self.create_file('a.txt', 'aaaa')
+        self.create_file('b.txt', 'bbbb')
+        self.create_file('c.txt', 'cccc')
+        self.create_file('big.txt', 'x' * 11)
+
+        cache = ContentCache(size=10)
+        a, b, c, big = [ContentReader(i, cache) for i in
+                        ('a.txt', 'b.txt', 'c.txt', 'big.txt')]
+        a(), b(), a(), c()
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.used, 8)
+
+        # Least recently used b.txt was removed.
+        a(), b()
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+        # Too big to be cached.
+        big()
+        self.assertLessEqual(cache.used, 10)
+        self.assertEqual(len(cache), 2)
+
+    def test_app_cache(self):
+
+        self.create_dir(SOURCE_DIR)
+        self.create_file(SOURCE_DIR + '/a.txt', 'apple')
+
+        r = Rucola('.')
+        r.get('a.txt').content
+        r.get('a.txt').content
+        self.assertEqual(r.cache.hits, 1)
+
+        r = Rucola('.', cache_size=0)
+        self.assertIsNone(r.cache)
+        self.assertEqual(r.get('a.txt').content, 'apple')
+
+
+class TestDiffDirs(BaseTest):
+    """diff_dirs()"""
+
+    def create_dirs(self):
+        for i in ('a', 'b'):
+            self.create_file(i + '/same.txt', 'apple')
+            self.create_file(i + '/deep/dir/same.txt', 'banana')
+            self.create_file(i + '/deep/dir/changed.txt', 'cherry ' + i)
+            self.create_file(i + '/deep/size.txt', 'x' * (i == 'a' and 5 or 6))
+        self.create_file('a/deep/removed.txt')
+        self.create_file('b/added/file.txt')
+
+    def test_diff(self):
+
+        self.create_dirs()
+        diff = diff_dirs('a', 'b', jobs=2)
+
+        self.assertListEqual(diff.added, ['added/file.txt'])
+        self.assertListEqual(diff.removed, ['deep/removed.txt'])
+        self.assertListEqual(diff.changed, ['deep/dir/changed.txt',
+                                            'deep/size.txt'])
+        self.assertEqual(diff.files, 10)
+        self.assertEqual(diff.bytes, 2 * (5 + 6 + 8))
+        self.assertFalse(diff.equal)
+        self.assertGreaterEqual(diff.throughput, 0)
+
+    def test_compare_dirs(self):
+
+        self.create_dirs()
+        self.assertFalse(compare_dirs('a', 'b'))
+        self.assertTrue(compare_dirs('a', 'a'))
+
+        # Differences in subdirectories only
+        self.remove_file('a/deep/removed.txt')
+        self.remove_file('b/added/file.txt')
+        self.create_file('b/deep/size.txt', 'x' * 5)
+        self.assertFalse(compare_dirs('a', 'b'))
+        self.create_file('b/deep/dir/changed.txt', 'cherry a')
+        self.assertTrue(compare_dirs('a', 'b'))
+
+    def test_hash_file(self):
+
+        self.create_file('a.txt', 'a' * 100000)
+        self.assertEqual(hash_file('a.txt'), rucola.hash_content('a' * 100000))
+
+
+class TestTransformCache(BaseTest):
+    """TransformCache"""
+
+    def test_get_set(self):
+
+        cache = TransformCache('cache')
+        key = cache.key('a', b'b')
+
+        self.assertIsNone(cache.get(key))
+        cache.set(key, {'content': 'apple'})
+        self.assertEqual(cache.get(key), {'content': 'apple'})
+        self.assertEqual(TransformCache('cache').get(key),
+                         {'content': 'apple'})
+        self.assertNotEqual(key, cache.key('ab', b''))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_broken(self):
+
+        cache = TransformCache('cache')
+        key = cache.key('a')
+        cache.set(key, 'apple')
+        self.create_file(os.path.join('cache', key[:2], key), 'broken')
+
+        self.assertEqual(cache.get(key, 'missing'), 'missing')
+
+    def test_evict(self):
+
+        cache = TransformCache('cache', size=2500)
+        keys = [cache.key(str(i)) for i in range(5)]
+        for i, key in enumerate(keys):
+            cache.set(key, str(i) * 1000)
+            os.utime(os.path.join('cache', key[:2], key), ns=(i, i))
+
+        self.assertLessEqual(cache.used, 2500)
+        self.assertEqual(cache.evictions, 3)
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.get(keys[4]), '4' * 1000)
+
+    def test_clear(self):
+
+        cache = TransformCache('cache')
+        cache.set(cache.key('a'), 'apple')
+        cache.clear()
+
+        self.assertFalse(os.path.exists('cache'))
+
+
+class TestContentReader(BaseTest):
+    """ContentReader"""
+
+    def test_read(self):
+
+        self.create_file('a.txt', 'apple')
+        self.assertEqual(ContentReader('a.txt')(), 'apple')
+
+    def test_binary(self):
+
+        with open('a.bin', 'wb') as f:
+            f.write(b'\x89PNG\xff')
+
+        reader = ContentReader('a.bin', binary=True)
+        self.assertEqual(reader(), b'\x89PNG\xff')
+        self.assertEqual(ContentReader('a.bin').read_bytes(), b'\x89PNG\xff')
+
+    def test_binary_cache(self):
+
+        self.create_file('a.txt', 'apple')
+        cache = ContentCache()
+        reader = ContentReader('a.txt', cache)
+
+        self.assertEqual(reader(), 'apple')
+        self.assertEqual(reader.read_bytes(), b'apple')
+        self.assertEqual(reader.read_bytes(), b'apple')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_head(self):
+
+        self.create_file('a.txt', 'apple\nbanana')
+        self.assertEqual(ContentReader('a.txt').head(3), 'app')
+        self.assertEqual(ContentReader('a.txt', binary=True).head(),
+                         b'apple\nbanana')
+
+    def test_split_header(self):
+
+        self.create_file('a.md', '---\ntitle: Apple\ntags: [a]\n---\n'
+                                 'body\n' + 'x' * 10000)
+        reader = ContentReader('a.md')
+        read = ContentReader.bytes_read
+
+        self.assertEqual(reader.split_header(), 'title: Apple\ntags: [a]\n')
+        self.assertLess(ContentReader.bytes_read - read, 10000)
+        self.assertEqual(reader.offset, 31)
+        self.assertEqual(reader(), 'body\n' + 'x' * 10000)
+        self.assertEqual(reader.read_bytes()[:5], b'body\n')
+        with reader.view() as data:
+            self.assertEqual(data[:4], b'body')
+
+    def test_split_header_unicode(self):
+
+        # Headers are decoded like text files, using a locale encoding.
+        encoding = locale.getpreferredencoding(False)
+        header = '---\r\ntitle: Żółw ✓\r\n---\r\n'
+        try:
+            data = (header + 'żółw').encode(encoding)
+        except UnicodeEncodeError:
+            self.skipTest('locale encoding is ' + encoding)
+        with open('a.md', 'wb') as f:
+            f.write(data)
+        reader = ContentReader('a.md')
+
+        self.assertEqual(reader.split_header(), 'title: Żółw ✓\n')
+        self.assertEqual(reader.offset, len(header.encode(encoding)))
+        self.assertEqual(reader.read_bytes(), 'żółw'.encode(encoding))
+        with reader.view() as data:
+            self.assertEqual(data.tobytes(), 'żółw'.encode(encoding))
+        self.assertEqual(reader(), 'żółw')
+
+    def test_split_header_missing(self):
+
+        self.create_file('a.md', 'apple\n---\n')
+        self.create_file('b.md', '---\nnot closed\n')
+        self.create_file('c.md', '---\n' + 'x' * 100 + '\n---\n')
+
+        for path in ('a.md', 'b.md', 'c.md'):
+            reader = ContentReader(path)
+            self.assertIsNone(reader.split_header(limit=50))
+            self.assertEqual(reader.offset, 0)
+
+    def test_split_header_cache(self):
+
+        self.create_file('a.md', '+++\na = 1\n+++\nbody')
+        cache = ContentCache()
+        reader = ContentReader('a.md', cache)
+
+        self.assertEqual(reader(), '+++\na = 1\n+++\nbody')
+        self.assertEqual(reader.split_header('+++'), 'a = 1\n')
+        self.assertEqual(reader(), 'body')
+        self.assertEqual(ContentReader('a.md', cache)(),
+                         '+++\na = 1\n+++\nbody')
+
+    def test_view(self):
+
+        with open('a.bin', 'wb') as f:
+            f.write(b'\x00\x01' * 1000)
+
+        with ContentReader('a.bin').view() as data:
+            self.assertEqual(len(data), 2000)
+            self.assertEqual(data[:4].tobytes(), b'\x00\x01\x00\x01')
+
+        self.create_file('empty.txt')
+        self.assertEqual(len(ContentReader('empty.txt').view()), 0)
+
+
+class TestFileList(BaseTest):
+    """FileList"""
+
+    def example_list(self):
+        return FileList([File('index.md'), File('posts/a.md'),
+                         File('posts/2015/b.md'), File('logo.jpg')])
+
+    def find(self, files, *patterns):
+        return [i.path for i in
+                files.candidates([compile_pattern(p) for p in patterns])
+                if any(pathmatch(i.path, p) for p in patterns)]
+
+    def test_lookup(self):
+
+        files = self.example_list()
+
+        self.assertIs(files.lookup('posts/a.md'), files[1])
+        self.assertIsNone(files.lookup('posts/c.md'))
+
+    def test_lookup_first(self):
+
+        files = self.example_list()
+        files.lookup('index.md')
+        files.insert(0, File('index.md', 'first'))
+
+        self.assertEqual(files.lookup('index.md').content, 'first')
+
+    def test_candidates(self):
+
+        files = self.example_list()
+
+        self.assertListEqual(self.find(files, 'posts/**/*.md'),
+                             ['posts/a.md', 'posts/2015/b.md'])
+        self.assertListEqual(self.find(files, 'posts/*.md'), ['posts/a.md'])
+        self.assertListEqual(self.find(files, '*.jpg', 'index.md'),
+                             ['index.md', 'logo.jpg'])
+        self.assertListEqual(self.find(files, 'missing/**/*'), [])
+
+    def test_candidates_pruned(self):
+
+        files = self.example_list()
+        found = files.candidates([compile_pattern('posts/**/*')])
+
+        self.assertCountEqual(found, [files[1], files[2]])
+
+    def test_path_changed(self):
+
+        files = self.example_list()
+        files.lookup('index.md')
+
+        files[1].path = 'about/index.html'
+        files[2]['path'] = 'posts/c.md'
+
+        self.assertIsNone(files.lookup('posts/a.md'))
+        self.assertIs(files.lookup('about/index.html'), files[1])
+        self.assertListEqual(self.find(files, 'posts/**/*'), ['posts/c.md'])
+
+    def test_path_changed_equal_lists(self):
+
+        a = self.example_list()
+        b = FileList(a)
+        a.lookup('index.md')
+        b.lookup('index.md')
+
+        a[1].path = 'about/index.html'
+
+        self.assertIsNone(b.lookup('posts/a.md'))
+        self.assertIs(b.lookup('about/index.html'), a[1])
+
+    def test_add_remove(self):
+
+        files = self.example_list()
+        files.lookup('index.md')
+
+        files.append(File('posts/d.md'))
+        self.assertIsNotNone(files.lookup('posts/d.md'))
+
+        files.remove(files.lookup('posts/a.md'))
+        self.assertIsNone(files.lookup('posts/a.md'))
+
+        del files[0]
+        self.assertIsNone(files.lookup('index.md'))
+
+        files.sort(key=lambda x: x.path)
+        self.assertListEqual(self.find(files, '**/*'),
+                             ['logo.jpg', 'posts/2015/b.md', 'posts/d.md'])
+
+    def test_remove_equal(self):
+
+        a, b = File('a'), File('a')
+        files = FileList([a, b])
+        files.lookup('a')
+        files.remove(b)
+
+        self.assertIs(files[0], a)
+        self.assertIs(files.lookup('a'), a)
+
+    def test_replace(self):
+
+        files = self.example_list()
+        files.lookup('index.md')
+        old = files[1]
+        new = File('posts/new.md')
+        files.replace(old, new)
+
+        self.assertIs(files[1], new)
+        self.assertIsNone(files.lookup('posts/a.md'))
+        self.assertIs(files.lookup('posts/new.md'), new)
+        self.assertListEqual(self.find(files, 'posts/**/*'),
+                             ['posts/new.md', 'posts/2015/b.md'])
+
+        old.path = 'posts/a.md'
+        self.assertIsNone(files.lookup('posts/a.md'))
+
+        files.replace(None, File('x.md'))
+        self.assertEqual(files[-1].path, 'x.md')
+
+    def test_detached(self):
+
+        files = self.example_list()
+        files.lookup('index.md')
+        file = files[0]
+        files.clear()
+
+        file.path = 'foo.md'
+        self.assertIsNone(files.lookup('foo.md'))
+
 
 class TestRucola(BaseTest):
     """Rucola"""
@@ -248,6 +796,34 @@ class TestRucola(BaseTest):
         x = [i.path for i in r.files]
         self.assertCountEqual(x, ['foo.txt', 'a.txt'])
 
+    def test_init_order(self):
+
+        self.create_dir('src')
+        for i in ('a/b/c.txt', 'a/d.txt', 'e.txt', 'f/g/h/i.txt', 'f/j.txt',
+                  'k/l.txt', 'm.txt'):
+            self.create_file('src/' + i)
+
+        expected = []
+        for path, dirs, files in os.walk('src'):
+            for f in files:
+                p = os.path.relpath(os.path.join(path, f), 'src')
+                expected.append(p.replace(os.sep, '/'))
+
+        for jobs in (1, 4):
+            r = Rucola('.', jobs=jobs)
+            self.assertListEqual([i.path for i in r.files], expected)
+
+    def test_init_stat(self):
+
+        self.create_dir('src')
+        self.create_file('src/a/b.txt', 'banana')
+
+        r = Rucola('.', jobs=2)
+        reader = r.get('a/b.txt').get_buffer()
+
+        self.assertEqual(reader.stat().st_size, 6)
+        self.assertEqual(reader.path, os.path.join(r.source, 'a', 'b.txt'))
+
     # TODO: ignore argument
 
     # def test_init_ignore(self):
@@ -262,7 +838,7 @@ class TestRucola(BaseTest):
 
     def test_source_not_found(self):
 
-        exc = IOError if PYTHON32 else FileNotFoundError
+        exc = FileNotFoundError
 
         # Missing main directory.
         self.assertRaises(exc, Rucola, 'project')
@@ -318,6 +894,40 @@ class TestRucola(BaseTest):
         self.assertEqual(self.read_file('build/index.md'), 'hello')
         self.assertIsInstance(f[0], File)
 
+    def test_build_split_header(self):
+
+        self.example_app()
+        self.create_file('src/post.md', '---\ntitle: Hi\n---\nhello')
+        r = Rucola('.', 'src', passthrough='hardlink')
+        r.get('post.md').get_buffer().split_header()
+        r.build()
+
+        self.assertEqual(self.read_file('build/post.md'), 'hello')
+        self.assertEqual(os.stat('build/logo.jpg').st_nlink, 2)
+
+    def test_writer(self):
+
+        r = self.example_app()
+        r.create('a/b/c/d.txt', content='deep')
+        os.makedirs('build/a')
+        writer = r.writer()
+
+        self.assertIsInstance(writer, OutputWriter)
+        self.assertEqual(writer.plan(r.files), 3)
+        self.assertEqual(writer.plan(r.files), 0)
+        self.assertTrue(os.path.isdir('build/a/b/c'))
+
+        self.assertEqual(writer.write(r.get('a/b/c/d.txt')), 4)
+        self.assertEqual(self.read_file('build/a/b/c/d.txt'), 'deep')
+
+        # Path changed after planning
+        r.get('index.md').path = 'new/index.md'
+        writer.write(r.get('new/index.md'))
+        self.assertEqual(self.read_file('build/new/index.md'), 'hello')
+
+        with self.assertRaises(ValueError):
+            r.writer(write='never')
+
     def test_build_recursive(self):
 
         r = self.example_app()
@@ -348,106 +958,432 @@ class TestRucola(BaseTest):
         self.assertFalse(r.get('posts/a.md') in r.files)
         self.assertFalse(r.get('posts/b.md') in r.files)
 
-    # get()
+    def test_files_list(self):
 
-    def test_get(self):
+        r = self.example_app()
+        r.files = [i for i in r.files if i.path != 'index.md']
 
-        self.create_dir('src')
-        self.create_file('src/fruit.txt', 'banana')
+        self.assertIsInstance(r.files, FileList)
+        self.assertIsNone(r.get('index.md'))
 
-        r = Rucola('.', source='src')
-        i = r.get('fruit.txt')
+    def test_build_jobs(self):
 
-        self.assertIsNotNone(i)
-        self.assertEqual(i.content, 'banana')
-        self.assertEqual(i.path, 'fruit.txt')
+        r = self.example_app()
+        files = r.build(jobs=4)
 
-    def test_get_nothing(self):
-        """get should returns None if a file is not found"""
+        self.assertListEqual(files, r.find('**/*'))
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+        self.assertEqual(self.read_file('build/posts/b.md'), 'banana')
+
+    def test_build_jobs_default(self):
 
         r = self.example_app()
-        self.assertIsNone(r.get('not_found'))
+        r.jobs = 4
+        r.build('**/*.md')
 
-    # find()
+        self.assertEqual(self.read_file('build/posts/b.md'), 'banana')
 
-    def test_find(self):
+    def test_build_jobs_errors(self):
 
         r = self.example_app()
-        files = r.find('**/*.jpg')
+        r.create('a.txt', content=1)
+        r.create('b.txt', content=2)
 
-        self.assertCountEqual(
-            files, [r.get('logo.jpg'),
-                    r.get('posts/image.jpg')]
-        )
+        with self.assertRaises(BuildError) as cm:
+            r.build(jobs=2)
 
-    def test_find_nothing(self):
-        self.assertFalse(self.example_app().find('404.html'))
+        self.assertListEqual([f.path for f, e in cm.exception.errors],
+                             ['a.txt', 'b.txt'])
+        # Other files are built.
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
 
-    def test_find_multiple(self):
+    def test_build_jobs_same_path(self):
 
         r = self.example_app()
-        files = r.find('*.jpg', 'posts/*.jpg')
+        r.get('posts/b.md').path = 'posts/a.md'
 
-        self.assertCountEqual(
-            files, [r.get('logo.jpg'),
-                    r.get('posts/image.jpg')]
-        )
+        with self.assertRaises(BuildError) as cm:
+            r.build(jobs=2)
 
-        # No multiple instances of one file in returned list
-        files = r.find('*.jpg', '*.jpg')
-        self.assertListEqual(files, [r.get('logo.jpg')])
+        self.assertEqual(len(cm.exception.errors), 1)
+        self.assertFalse(os.path.exists('build/index.md'))
 
-    def test_find_multiple_recursively(self):
+    # build(incremental=True)
 
-        r = self.example_app()
-        files = r.find('posts/a.md', '**/*.md')
+    def tamper(self, path, content):
+        """Changes an output file content, but keeps its size and mtime."""
 
-        self.assertCountEqual(
-            files, [r.get('index.md'),
-                    r.get('posts/a.md'),
-                    r.get('posts/b.md')]
-        )
+        stat = os.stat(path)
+        with open(path, 'w') as f:
+            f.write(content)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
 
-    def test_find_safe_delete(self):
+    def test_build_incremental(self):
 
-        r = self.example_app()
+        r = self.example_app(incremental=True)
+        r.build()
 
-        for i in r.find('**/*.md'):
-            r.files.remove(i)
+        self.assertTrue(os.path.exists(join('build', MANIFEST_FILE)))
 
-        self.assertFalse(r.find('**/*.md'))
+        self.tamper('build/index.md', 'HELLO')
+        self.tamper('build/posts/a.md', 'APPLE')
+        self.create_file('src/posts/a.md', 'avocado')
 
-    def test_ifind(self):
+        Rucola('.', incremental=True).build()
+
+        self.assertEqual(self.read_file('build/index.md'), 'HELLO')
+        self.assertEqual(self.read_file('build/posts/a.md'), 'avocado')
+
+    def test_build_incremental_content(self):
 
         r = self.example_app()
-        files = r.ifind('**/*.md')
+        r.get('index.md').content = 'hi'
+        r.get('posts/a.md').content = 'hi'
+        r.build(incremental=True)
 
-        self.assertIsInstance(files, types.GeneratorType)
-        files = [i for i in files]
-        self.assertEqual(3, len(files))
-        self.assertCountEqual(
-            files, [r.get('index.md'),
-                    r.get('posts/a.md'),
-                    r.get('posts/b.md')]
-        )
+        self.tamper('build/index.md', 'HI')
+        self.tamper('build/posts/a.md', 'HI')
 
-    # create()
+        r.get('posts/a.md').content = 'yo'
+        r.build(incremental=True)
 
-    def test_create(self):
-        """create() should creates and returns a correct file"""
+        self.assertEqual(self.read_file('build/index.md'), 'HI')
+        self.assertEqual(self.read_file('build/posts/a.md'), 'yo')
 
-        self.create_dir(SOURCE_DIR)
-        r = Rucola('.', output='build')
+    def test_build_incremental_output_changed(self):
 
-        file = r.create('foo.html', content='bar')
-        self.assertIsInstance(file, File)
-        self.assertEqual(file['path'], 'foo.html')
-        self.assertEqual(file['content'], 'bar')
+        r = self.example_app()
+        r.build(incremental=True)
 
-        file = r.create('bar.html')
-        self.assertEqual(file['content'], '')
+        os.remove('build/index.md')
+        self.create_file('build/posts/a.md', 'changed')
+        r.build(incremental=True)
 
-    def test_create_utf_content(self):
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+
+    def test_build_incremental_cleared(self):
+
+        r = self.example_app()
+        r.build(incremental=True)
+        self.tamper('build/index.md', 'HELLO')
+
+        r.clear_output()
+        r.build(incremental=True)
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+
+    def test_build_incremental_broken_manifest(self):
+
+        r = self.example_app()
+        self.create_file('build/' + MANIFEST_FILE, '{broken')
+        r.build(incremental=True)
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+
+    # build(write=...)
+
+    def test_build_write_always(self):
+
+        r = self.example_app()
+        r.build()
+        self.tamper('build/index.md', 'HELLO')
+        r.build(write='always')
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertListEqual(r.skipped, [])
+
+    def test_build_write_if_changed(self):
+
+        r = self.example_app(write='if-changed')
+        r.get('posts/a.md').content = 'avocado'
+        r.build()
+
+        mtime = os.stat('build/posts/a.md').st_mtime_ns
+        os.utime('build/posts/a.md', ns=(mtime - 10**9, mtime - 10**9))
+
+        r.get('posts/b.md').content = 'blueberry'
+        r.build()
+
+        self.assertEqual(os.stat('build/posts/a.md').st_mtime_ns,
+                         mtime - 10**9)
+        self.assertEqual(self.read_file('build/posts/b.md'), 'blueberry')
+        self.assertEqual(len(r.skipped), 4)
+        self.assertNotIn(r.get('posts/b.md'), r.skipped)
+
+    def test_build_write_if_changed_same_size(self):
+
+        r = self.example_app()
+        r.build()
+        self.create_file('build/index.md', 'HELLO')
+        self.create_file('build/posts/a.md', 'APPLE')
+        r.get('posts/a.md').content = 'APPLE'
+        r.build(write='if-changed')
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertIn(r.get('posts/a.md'), r.skipped)
+
+    def test_build_write_mtime(self):
+
+        r = self.example_app()
+        r.build()
+        self.tamper('build/index.md', 'HELLO')
+        self.create_file('build/posts/a.md', 'APPLE')
+        os.utime('build/posts/a.md', (0, 0))
+        r.build(write='mtime')
+
+        self.assertEqual(self.read_file('build/index.md'), 'HELLO')
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+
+    def test_build_write_unknown(self):
+        self.assertRaises(ValueError, self.example_app().build, write='x')
+
+    # build(passthrough=...)
+
+    def test_build_hardlink(self):
+
+        r = self.example_app()
+        r.get('index.md').content = 'changed'
+        r.build(passthrough='hardlink')
+
+        self.assertTrue(os.path.samefile('src/posts/a.md', 'build/posts/a.md'))
+        self.assertFalse(os.path.samefile('src/index.md', 'build/index.md'))
+
+        # Writing a new content must not change a linked source.
+        r.get('posts/a.md').content = 'avocado'
+        r.build()
+
+        self.assertEqual(self.read_file('build/posts/a.md'), 'avocado')
+        self.assertEqual(self.read_file('src/posts/a.md'), 'apple')
+
+    def test_build_symlink(self):
+
+        r = self.example_app()
+        r.build(passthrough='symlink')
+
+        self.assertTrue(os.path.islink('build/posts/a.md'))
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+
+        r.build(passthrough='copy')
+
+        self.assertFalse(os.path.islink('build/posts/a.md'))
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+
+    def test_build_reflink(self):
+
+        r = self.example_app()
+        try:
+            r.build('index.md', passthrough='reflink')
+        except OSError:
+            self.assertFalse(os.path.exists('build/index.md'))
+            self.skipTest('reflinks not supported')
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+
+    def test_build_auto(self):
+
+        r = self.example_app()
+        r.build(passthrough='auto')
+        r.build(passthrough='auto')
+
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertEqual(self.read_file('build/posts/b.md'), 'banana')
+        self.assertEqual(os.stat('build/logo.jpg').st_nlink, 1)
+
+    def test_kernel_copy_file(self):
+
+        r = self.example_app()
+        rucola.kernel_copy_file('src/index.md', 'copy.md')
+
+        self.assertEqual(self.read_file('copy.md'), 'hello')
+
+    def test_build_passthrough_unknown(self):
+        self.assertRaises(ValueError, self.example_app().build,
+                          passthrough='x')
+
+    # ibuild()
+
+    def test_ibuild(self):
+
+        r = self.example_app()
+        results = r.ibuild('**/*.md')
+
+        self.assertIsInstance(results, types.GeneratorType)
+        self.assertFalse(os.path.exists('build/index.md'))
+
+        result = next(results)
+        self.assertIsInstance(result, BuildResult)
+        self.assertIs(result.file, r.get('index.md'))
+        self.assertTrue(result.written)
+        self.assertEqual(result.size, 5)
+        self.assertGreaterEqual(result.time, 0)
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+        self.assertFalse(os.path.exists('build/posts/a.md'))
+
+        self.assertCountEqual([i.file.path for i in results],
+                              ['posts/a.md', 'posts/b.md'])
+
+    def test_ibuild_jobs(self):
+
+        r = self.example_app()
+        for i in range(20):
+            r.create('page{}.html'.format(i), content=str(i))
+
+        paths = [i.file.path for i in r.ibuild(jobs=3)]
+        self.assertListEqual(paths, [i.path for i in r.files])
+        self.assertEqual(self.read_file('build/page19.html'), '19')
+
+    def test_ibuild_remove(self):
+
+        r = self.example_app()
+        for result in r.ibuild('posts/*', jobs=2):
+            r.files.remove(result.file)
+
+        self.assertCountEqual([i.path for i in r.files],
+                              ['index.md', 'logo.jpg'])
+
+    def test_ibuild_skipped(self):
+
+        r = self.example_app()
+        r.build()
+        results = list(r.ibuild('posts/*.md', write='if-changed'))
+
+        self.assertListEqual([i.written for i in results], [False, False])
+        self.assertListEqual([i.size for i in results], [0, 0])
+        self.assertEqual(len(r.skipped), 2)
+
+    def test_ibuild_break(self):
+
+        r = self.example_app()
+        for result in r.ibuild(incremental=True, jobs=2):
+            break
+
+        self.assertTrue(os.path.exists(join('build', MANIFEST_FILE)))
+
+    # get()
+
+    def test_get_renamed(self):
+
+        r = self.example_app()
+        file = r.get('index.md')
+        file.path = 'home.md'
+
+        self.assertIsNone(r.get('index.md'))
+        self.assertIs(r.get('home.md'), file)
+
+    def test_get_pattern(self):
+
+        r = self.example_app()
+        self.assertEqual(r.get('posts/*.jpg').path, 'posts/image.jpg')
+
+    def test_get(self):
+
+        self.create_dir('src')
+        self.create_file('src/fruit.txt', 'banana')
+
+        r = Rucola('.', source='src')
+        i = r.get('fruit.txt')
+
+        self.assertIsNotNone(i)
+        self.assertEqual(i.content, 'banana')
+        self.assertEqual(i.path, 'fruit.txt')
+
+    def test_get_nothing(self):
+        """get should returns None if a file is not found"""
+
+        r = self.example_app()
+        self.assertIsNone(r.get('not_found'))
+
+    # find()
+
+    def test_find(self):
+
+        r = self.example_app()
+        files = r.find('**/*.jpg')
+
+        self.assertCountEqual(
+            files, [r.get('logo.jpg'),
+                    r.get('posts/image.jpg')]
+        )
+
+    def test_find_order(self):
+
+        r = self.example_app()
+        r.files.sort(key=lambda x: x.path, reverse=True)
+
+        self.assertListEqual(
+            [i.path for i in r.find('posts/**/*', 'index.md')],
+            ['posts/image.jpg', 'posts/b.md', 'posts/a.md', 'index.md'])
+
+    def test_find_nothing(self):
+        self.assertFalse(self.example_app().find('404.html'))
+
+    def test_find_multiple(self):
+
+        r = self.example_app()
+        files = r.find('*.jpg', 'posts/*.jpg')
+
+        self.assertCountEqual(
+            files, [r.get('logo.jpg'),
+                    r.get('posts/image.jpg')]
+        )
+
+        # No multiple instances of one file in returned list
+        files = r.find('*.jpg', '*.jpg')
+        self.assertListEqual(files, [r.get('logo.jpg')])
+
+    def test_find_multiple_recursively(self):
+
+        r = self.example_app()
+        files = r.find('posts/a.md', '**/*.md')
+
+        self.assertCountEqual(
+            files, [r.get('index.md'),
+                    r.get('posts/a.md'),
+                    r.get('posts/b.md')]
+        )
+
+    def test_find_safe_delete(self):
+
+        r = self.example_app()
+
+        for i in r.find('**/*.md'):
+            r.files.remove(i)
+
+        self.assertFalse(r.find('**/*.md'))
+
+    def test_ifind(self):
+
+        r = self.example_app()
+        files = r.ifind('**/*.md')
+
+        self.assertIsInstance(files, types.GeneratorType)
+        files = [i for i in files]
+        self.assertEqual(3, len(files))
+        self.assertCountEqual(
+            files, [r.get('index.md'),
+                    r.get('posts/a.md'),
+                    r.get('posts/b.md')]
+        )
+
+    # create()
+
+    def test_create(self):
+        """create() should creates and returns a correct file"""
+
+        self.create_dir(SOURCE_DIR)
+        r = Rucola('.', output='build')
+
+        file = r.create('foo.html', content='bar')
+        self.assertIsInstance(file, File)
+        self.assertEqual(file['path'], 'foo.html')
+        self.assertEqual(file['content'], 'bar')
+
+        file = r.create('bar.html')
+        self.assertEqual(file['content'], '')
+
+    def test_create_utf_content(self):
         """create() should supports the utf content"""
 
         r = self.example_app()
@@ -465,6 +1401,20 @@ class TestRucola(BaseTest):
         self.assertEqual(self.read_file('build/bytes'), '1234')
 
 
+    def test_create_bytes_like(self):
+
+        self.create_file('data.bin', 'banana')
+
+        r = self.example_app()
+        r.create('bytearray', content=bytearray(b'1234'))
+        r.create('memoryview', content=memoryview(b'12345678').cast('I'))
+        r.create('mmap', content=ContentReader('data.bin').view())
+        r.build()
+
+        self.assertEqual(self.read_file('build/bytearray'), '1234')
+        self.assertEqual(self.read_file('build/memoryview'), '12345678')
+        self.assertEqual(self.read_file('build/mmap'), 'banana')
+
     # use()
 
     # TODO: Test order of plugins usage
@@ -495,6 +1445,638 @@ class TestRucola(BaseTest):
 
         self.assertEqual('AB', r.test)
 
+    # depends()
+
+    def layout_app(self, **kwargs):
+        self.example_app()
+        self.create_file('src/layout.html', '<p>{}</p>')
+        return Rucola('.', source='src', output='build', **kwargs)
+
+    def layout(self, app):
+        """Plugin that puts a content of all .md files into a layout."""
+
+        html = app.get('layout.html').content
+        for file in app.find('**/*.md'):
+            file.content = html.format(file.content)
+
+    def test_depends(self):
+
+        r = self.example_app()
+        a, b, c = r.get('index.md'), r.get('posts/a.md'), r.get('logo.jpg')
+
+        self.assertListEqual(r.depends(a), [])
+        self.assertListEqual(r.depends(a, on=[b, a]), [b])
+        self.assertListEqual(r.depends(a, on=[b, c]), [b, c])
+        r.depends(c, on=[b])
+        self.assertListEqual(r._all_depends(a), [b, c])
+
+    def test_depends_tracked(self):
+
+        r = self.layout_app()
+        r.use(self.layout)
+        layout = r.get('layout.html')
+
+        self.assertEqual(r.get('index.md').content, '<p>hello</p>')
+        for path in ('index.md', 'posts/a.md', 'posts/b.md'):
+            self.assertListEqual(r.depends(r.get(path)), [layout])
+        self.assertListEqual(r.depends(layout), [])
+        self.assertListEqual(r.depends(r.get('logo.jpg')), [])
+
+    def test_depends_created(self):
+
+        def index(app):
+            posts = app.find('posts/*.md')
+            content = ', '.join(i.content for i in posts)
+            app.files.append(File('all.txt', content))
+
+        r = self.example_app()
+        r.use(index)
+        self.assertCountEqual(r.depends(r.get('all.txt')),
+                              r.find('posts/*.md'))
+
+    def test_depends_created_each(self):
+
+        def pages(app):
+            for file in app.find('**/*.md'):
+                app.create(file.path[:-3] + '.html', content=file.content)
+
+        r = self.example_app()
+        r.use(pages)
+
+        # index.md was read before the first file was created.
+        index = r.get('index.md')
+        self.assertListEqual(r.depends(r.get('index.html')), [index])
+        for path in ('posts/a', 'posts/b'):
+            self.assertListEqual(r.depends(r.get(path + '.html')),
+                                 [r.get(path + '.md'), index])
+
+    def test_dirty(self):
+
+        r = self.layout_app(incremental=True)
+        self.assertEqual(len(r.dirty()), 6)
+        r.use(self.layout)
+        r.build()
+
+        r = Rucola('.', incremental=True)
+        self.assertListEqual(r.dirty(), [])
+
+        self.create_file('src/layout.html', '<div>{}</div>')
+        self.create_file('src/posts/image.jpg', 'new')
+        r = Rucola('.', incremental=True)
+        self.assertCountEqual([i.path for i in r.dirty()],
+                              ['layout.html', 'index.md', 'posts/a.md',
+                               'posts/b.md', 'posts/image.jpg'])
+
+    def test_dirty_shared(self):
+
+        r = self.layout_app(incremental=True)
+        r.use(self.layout)
+        r.build()
+
+        # The layout is stored once, shared by all pages.
+        with open(join('build', MANIFEST_FILE), encoding='utf-8') as f:
+            data = json.load(f)
+        self.assertEqual(len(data['groups']), 1)
+        key, = data['groups']
+        self.assertEqual(list(data['groups'][key]['depends']),
+                         [os.path.abspath(join('src', 'layout.html'))])
+        self.assertEqual(data['files']['posts/a.md']['groups'], [key])
+
+        self.create_file('src/layout.html', '<div>{}</div>')
+        r = Rucola('.', incremental=True)
+        self.assertCountEqual([i.path for i in r.dirty()],
+                              ['layout.html', 'index.md', 'posts/a.md',
+                               'posts/b.md'])
+
+    def test_watch_tracked(self):
+
+        r = self.layout_app()
+        r.use(self.layout)
+
+        calls = self.watch(r, [
+            lambda: self.create_file('src/layout.html', '<div>{}</div>')])
+
+        self.assertCountEqual(calls[1], ['layout.html', 'index.md',
+                                         'posts/a.md', 'posts/b.md'])
+
+    def test_watch_created(self):
+
+        def index(app):
+            posts = app.find('posts/*.md')
+            content = ','.join(i.content for i in posts)
+            app.files.append(File('index.html', content))
+
+        r = self.example_app()
+        r.use(index)
+        old = r.get('posts/a.md')
+
+        calls = self.watch(r, [
+            lambda: self.create_file('src/posts/a.md', 'avocado')])
+
+        self.assertListEqual(calls[1], ['posts/a.md', 'index.html'])
+        depends = r.depends(r.get('index.html'))
+        self.assertFalse(any(i is old for i in depends))
+        self.assertTrue(any(i is r.get('posts/a.md') for i in depends))
+
+    # cached()
+
+    def test_cached(self):
+
+        calls = []
+
+        def render(app):
+
+            @app.cached('upper', 1, metadata=['lang'])
+            def upper(file):
+                calls.append(file.path)
+                return file.content.upper()
+
+            for file in app.find('**/*.md'):
+                file.content = upper(file)
+
+        r = self.example_app()
+        r.use(render)
+        self.assertEqual(r.get('index.md').content, 'HELLO')
+        self.assertEqual(len(calls), 3)
+
+        r = Rucola('.', source='src', output='build')
+        r.use(render)
+        self.assertEqual(r.get('index.md').content, 'HELLO')
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(os.path.isdir('.rucola-cache'))
+
+        self.create_file('src/index.md', 'hi')
+        r = Rucola('.', source='src', output='build')
+        r.get('posts/a.md')['lang'] = 'en'
+        r.use(render)
+        self.assertEqual(r.get('index.md').content, 'HI')
+        self.assertCountEqual(calls[3:], ['index.md', 'posts/a.md'])
+
+    def test_cached_version(self):
+
+        r = self.example_app()
+        file = r.get('index.md')
+        key = r.cached('a', 1)(str.upper).key
+
+        self.assertEqual(key(file), r.cached('a', 1)(str.upper).key(file))
+        self.assertNotEqual(key(file), r.cached('a', 2)(str.upper).key(file))
+        self.assertNotEqual(key(file), r.cached('b', 1)(str.upper).key(file))
+        before = key(file)
+        file['title'] = 'Hello'
+        self.assertNotEqual(key(file), before)
+
+    # map()
+
+    def test_map(self):
+
+        r = self.example_app()
+        r.get('index.md')['title'] = 'Hi'
+        r.map('**/*', upper_transform, jobs=1)
+
+        self.assertEqual(r.get('index.md').content, 'HELLO')
+        self.assertEqual(r.get('index.md')['title'], 'Hi')
+        self.assertEqual(r.get('posts/a.md').content, 'APPLE')
+        self.assertIsNone(r.get('posts/b.md'))
+        self.assertTrue(r.get('logo.jpg').has_buffer())
+        self.assertEqual(len(r.files), 4)
+
+    def test_map_processes(self):
+
+        r = self.example_app()
+        r.map('**/*.md', upper_transform, jobs=2)
+
+        self.assertEqual(r.get('posts/a.md').content, 'APPLE')
+        self.assertNotEqual(r.get('posts/a.md')['pid'], os.getpid())
+        self.assertIsNone(r.get('posts/b.md'))
+
+    def test_use_map_plugin(self):
+
+        r = self.example_app()
+        r.use(UpperPlugin())
+
+        self.assertEqual(r.get('index.md').content, 'hello')
+        self.assertEqual(r.get('posts/a.md').content, 'APPLE')
+        self.assertEqual(r.get('posts/a.md')['pid'], os.getpid())
+
+    def test_use_callable_with_pattern(self):
+
+        class Permalinks:
+            pattern = 'posts/*'
+
+            def transform(self, path):
+                return path[:-3] + '/index.html'
+
+            def __call__(self, app):
+                for file in app.find(self.pattern):
+                    file.path = self.transform(file.path)
+
+        r = self.example_app()
+        r.use(Permalinks())
+        self.assertIsNotNone(r.get('posts/a/index.html'))
+        self.assertIsNone(r.get('posts/a.md'))
+
+    # profile
+
+    def test_profile(self):
+
+        def plugin(app):
+            app.create('new.txt')
+            app.files.remove(app.get('index.md'))
+            app.get('posts/a.md').content
+
+        r = self.example_app(profile=True)
+        r.use(plugin)
+        r.build()
+
+        self.assertEqual(len(r.stats), 2)
+        stats = r.stats[0]
+        self.assertEqual(stats.name, repr(plugin))
+        self.assertEqual((stats.added, stats.removed), (1, 1))
+        self.assertEqual(stats.read, 5)
+        self.assertGreaterEqual(stats.wall, 0)
+        self.assertGreaterEqual(stats.cpu, 0)
+        self.assertIsNone(stats.memory)
+        self.assertEqual(r.stats[1].name, 'build(**/*)')
+
+        table = r.format_stats().splitlines()
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table[0].startswith('plugin'))
+        self.assertTrue(table[2].startswith('build(**/*)'))
+
+    def test_profile_memory(self):
+
+        def plugin(app):
+            app.data = [str(i) * 10 for i in range(10000)]
+
+        r = self.example_app(profile=True)
+        tracemalloc.start()
+        try:
+            r.use(plugin)
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(r.stats[0].memory, 100000)
+
+    def test_profile_disabled(self):
+
+        r = self.example_app()
+        r.use(lambda app: None)
+        r.build()
+
+        self.assertListEqual(r.stats, [])
+
+    # watch()
+
+    def watch(self, app, actions, **kwargs):
+        """Runs app.watch(), before each scan calls next function from
+        `actions`. Returns list of paths given to a callback."""
+
+        calls = []
+        actions = iter(actions)
+
+        def callback(app, files):
+            calls.append([i.path for i in files])
+            for action in actions:
+                action()
+                return True
+            return False
+
+        app.watch(callback, interval=0.01, **kwargs)
+        return calls
+
+    def test_watch(self):
+
+        r = self.example_app()
+        old = r.get('posts/a.md')
+
+        calls = self.watch(r, [
+            lambda: self.create_file('src/posts/a.md', 'avocado'),
+            lambda: self.create_file('src/posts/c.md', 'cherry'),
+            lambda: self.remove_file('src/index.md'),
+        ])
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(len(calls[0]), 5)
+        self.assertListEqual(calls[1:], [['posts/a.md'], ['posts/c.md'], []])
+
+        self.assertIsNot(r.get('posts/a.md'), old)
+        self.assertEqual(r.get('posts/a.md').content, 'avocado')
+        self.assertEqual(r.get('posts/c.md').content, 'cherry')
+        self.assertIsNone(r.get('index.md'))
+        self.assertEqual(len(r.files), 5)
+
+    def test_watch_depends(self):
+
+        r = self.example_app()
+        calls = self.watch(
+            r, [lambda: self.create_file('src/logo.jpg', 'new logo')],
+            depends={'*.jpg': ['posts/*.md', 'index.md']})
+
+        self.assertCountEqual(calls[1], ['logo.jpg', 'index.md',
+                                         'posts/a.md', 'posts/b.md'])
+
+    def test_watch_error(self):
+
+        def callback(app, files):
+            calls.append(files)
+            if len(calls) == 1:
+                self.create_file('src/index.md', 'hi')
+                raise ValueError('broken')
+            return False
+
+        calls = []
+        self.example_app().watch(callback, interval=0.01)
+        self.assertEqual(len(calls), 2)
+
+    # asyncio
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_build_async(self):
+
+        paths = []
+
+        async def progress(result):
+            paths.append(result.file.path)
+
+        r = self.example_app(incremental=True)
+        files = self.run_async(r.build_async('**/*.md', concurrency=2,
+                                       progress=progress))
+
+        self.assertListEqual([i.path for i in files],
+                             [i.path for i in r.find('**/*.md')])
+        self.assertCountEqual(paths, ['index.md', 'posts/a.md', 'posts/b.md'])
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+        self.assertTrue(os.path.exists(join('build', MANIFEST_FILE)))
+
+        self.run_async(r.build_async(progress=lambda result: None))
+        self.assertEqual(len(r.skipped), 3)
+
+    def test_build_async_errors(self):
+
+        r = self.example_app()
+        r.create('bad.txt', content=lambda: 1 / 0)
+
+        with self.assertRaises(BuildError) as e:
+            self.run_async(r.build_async(concurrency=3))
+
+        self.assertEqual(len(e.exception.errors), 1)
+        self.assertIs(e.exception.errors[0][0], r.get('bad.txt'))
+        self.assertEqual(self.read_file('build/posts/b.md'), 'banana')
+
+    def test_build_async_cancel(self):
+
+        async def build():
+            task = asyncio.ensure_future(r.build_async(
+                concurrency=1, progress=lambda result: task.cancel()))
+            await task
+
+        r = self.example_app(incremental=True)
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(build())
+
+        # One file being written may be finished in the background.
+        self.assertLessEqual(sum(len(i) for p, d, i in os.walk('build')), 3)
+        self.assertTrue(os.path.exists(join('build', MANIFEST_FILE)))
+
+    def test_load_async(self):
+
+        counts = []
+        self.example_app()
+        r = Rucola('.', 'src', load=False)
+        self.assertListEqual(r.files, [])
+
+        self.run_async(r.load_async(progress=counts.append, batch=2))
+        self.assertEqual(len(r.files), 5)
+        self.assertListEqual(counts, [2, 4, 5])
+        self.assertEqual(r.get('posts/a.md').content, 'apple')
+
+        r.files = []
+        self.assertEqual(len(r.load().files), 5)
+
+    # sync
+
+    def test_build_sync(self):
+
+        r = self.example_app()
+        r.build()
+        self.create_file('build/old.html', 'old')
+        self.create_file('build/old/dir/page.html', 'old')
+        self.create_file('build/posts/old.md', 'old')
+        r.files.remove(r.get('logo.jpg'))
+
+        r.build('posts/*', sync=True)
+
+        self.assertFalse(os.path.exists('build/old.html'))
+        self.assertFalse(os.path.exists('build/old'))
+        self.assertFalse(os.path.exists('build/posts/old.md'))
+        self.assertFalse(os.path.exists('build/logo.jpg'))
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+
+    def test_build_sync_incremental(self):
+
+        r = self.example_app(incremental=True, sync=True)
+        r.build()
+        r.files.remove(r.get('posts/a.md'))
+        mtime = os.stat('build/index.md').st_mtime_ns
+        r.build()
+
+        self.assertFalse(os.path.exists('build/posts/a.md'))
+        self.assertTrue(os.path.exists(join('build', MANIFEST_FILE)))
+        self.assertEqual(os.stat('build/index.md').st_mtime_ns, mtime)
+        self.assertListEqual(r.prune_output(), [])
+
+    def test_ibuild_sync_remove(self):
+
+        r = self.example_app(sync=True)
+        for result in r.ibuild('posts/*'):
+            r.files.remove(result.file)
+
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+        self.assertEqual(self.read_file('build/posts/b.md'), 'banana')
+
+    def test_build_sync_file(self):
+
+        r = self.example_app(sync=True)
+        r.build()
+        r.build(File('cat.txt', 'meow'))
+
+        self.assertEqual(self.read_file('build/cat.txt'), 'meow')
+        self.assertEqual(self.read_file('build/index.md'), 'hello')
+
+    # fingerprint()
+
+    def test_fingerprint(self):
+
+        r = self.example_app()
+        r.create('app.css', content='body {}')
+        result = r.fingerprint('**/*.jpg', 'app.css', length=6)
+
+        empty = rucola.hash_content('')[:6]
+        css = rucola.hash_content('body {}')[:6]
+        self.assertDictEqual(result, {
+            'logo.jpg': 'logo.{}.jpg'.format(empty),
+            'posts/image.jpg': 'posts/image.{}.jpg'.format(empty),
+            'app.css': 'app.{}.css'.format(css)})
+        self.assertIsNotNone(r.get('app.{}.css'.format(css)))
+        self.assertIsNone(r.get('logo.jpg'))
+
+        self.assertEqual(r.asset_url('logo.jpg'), 'logo.{}.jpg'.format(empty))
+        self.assertEqual(r.asset_url('index.md'), 'index.md')
+        with self.assertRaises(KeyError):
+            r.asset_url('missing.css')
+
+        r.build()
+        self.assertDictEqual(json.loads(self.read_file('build/assets.json')),
+                             result)
+
+    def test_fingerprint_again(self):
+
+        r = self.example_app()
+        r.create('app.css', content='body {}')
+        css = 'app.{}.css'.format(rucola.hash_content('body {}')[:8])
+
+        self.assertDictEqual(r.fingerprint('*.css'), {'app.css': css})
+        self.assertDictEqual(r.fingerprint('**/*'), {
+            'index.md': r.asset_url('index.md'),
+            'logo.jpg': r.asset_url('logo.jpg'),
+            'posts/a.md': r.asset_url('posts/a.md'),
+            'posts/b.md': r.asset_url('posts/b.md'),
+            'posts/image.jpg': r.asset_url('posts/image.jpg')})
+
+        self.assertEqual(r.asset_url('app.css'), css)
+        self.assertIsNotNone(r.get(css))
+        self.assertEqual(len(r.find('assets*.json')), 1)
+        self.assertEqual(json.loads(r.get('assets.json').content), r.assets)
+
+    def test_fingerprint_reuse(self):
+
+        r = self.example_app()
+        r.fingerprint('posts/a.md')
+
+        # Hash is taken from a previous call, because mtime and size match.
+        self.tamper('src/posts/a.md', 'melon')
+        r = Rucola('.', 'src')
+        path = r.fingerprint('posts/a.md', manifest=None)['posts/a.md']
+        self.assertIn(rucola.hash_content('apple')[:8], path)
+        self.assertIsNone(r.get('assets.json'))
+
+        self.create_file('src/posts/a.md', 'lemon')
+        r = Rucola('.', 'src')
+        path = r.fingerprint('posts/a.md')['posts/a.md']
+        self.assertIn(rucola.hash_content('lemon')[:8], path)
+
+    # compress
+
+    def test_build_compress(self):
+
+        r = self.example_app(incremental=True, sync=True)
+        r.create('big.md', content='banana ' * 1000)
+        r.build(compress=Precompress('**/*.md', min_size=6,
+                                     formats=('gzip', 'deflate'), jobs=2))
+
+        with gzip.open('build/big.md.gz', 'rt') as f:
+            self.assertEqual(f.read(), 'banana ' * 1000)
+        with open('build/posts/b.md.zz', 'rb') as f:
+            self.assertEqual(zlib.decompress(f.read()), b'banana')
+        self.assertFalse(os.path.exists('build/posts/a.md.gz'))
+        self.assertFalse(os.path.exists('build/logo.jpg.gz'))
+
+        # Sidecars of not changed files are not written again.
+        self.tamper('build/posts/b.md.gz', 'x' * 26)
+        r.build(compress=Precompress('**/*.md', min_size=6))
+        self.assertEqual(self.read_file('build/posts/b.md.gz'), 'x' * 26)
+        self.assertTrue(os.path.exists('build/big.md.zz'))
+
+        os.remove('build/big.md.gz')
+        r.build(compress=Precompress('**/*.md', min_size=6))
+        self.assertTrue(os.path.exists('build/big.md.gz'))
+
+    def test_compress_file(self):
+
+        self.create_file('a.html', 'apple')
+        self.create_file('a.html.gz', 'old')
+
+        self.assertEqual(compress_file('a.html', min_size=10), 0)
+        self.assertFalse(os.path.exists('a.html.gz'))
+
+        self.assertGreater(compress_file('a.html'), 0)
+        with open('a.html.gz', 'rb') as f:
+            data = f.read()
+        self.assertEqual(gzip.decompress(data), b'apple')
+        compress_file('a.html')
+        with open('a.html.gz', 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertEqual(os.stat('a.html.gz').st_mtime_ns,
+                         os.stat('a.html').st_mtime_ns)
+
+        with self.assertRaises(ValueError):
+            Precompress(formats=['brotli'])
+
+    def test_precompress_pool(self):
+
+        compress = Precompress(jobs=2)
+        compress.start()
+        pool = compress._pool
+        compress.start()
+        self.assertIs(compress._pool, pool)
+        if hasattr(pool, '_mp_context'):
+            self.assertNotEqual(pool._mp_context.get_start_method(), 'fork')
+        self.assertListEqual(compress.finish(), [])
+        self.assertIsNone(compress._pool)
+
+    # sharding
+
+    def build_shards(self, shards):
+        r = self.example_app()
+        built = []
+        for i in range(shards):
+            r.output = 'build-{}'.format(i)
+            built.append([f.path for f in r.build(shard=i, shards=shards)])
+        return built
+
+    def test_build_shards(self):
+
+        built = self.build_shards(3)
+
+        self.assertCountEqual(sum(built, []), [
+            'index.md', 'logo.jpg', 'posts/a.md', 'posts/b.md',
+            'posts/image.jpg'])
+        for i, paths in enumerate(built):
+            for path in paths:
+                self.assertEqual(shard_of(path, 3), i)
+            self.assertTrue(os.path.exists(join('build-' + str(i), SHARD_FILE)))
+
+        self.assertEqual(shard_of('posts/a.md', 3),
+                         shard_of('posts/./a.md', 3))
+        with self.assertRaises(ValueError):
+            Rucola('.', 'src').build(shard=3, shards=3)
+
+    def test_merge_shards(self):
+
+        self.build_shards(2)
+        paths = merge_shards('build', ['build-0', 'build-1'])
+
+        self.assertEqual(len(paths), 5)
+        self.assertEqual(self.read_file('build/posts/a.md'), 'apple')
+        self.assertFalse(os.path.exists(join('build', SHARD_FILE)))
+
+    def test_merge_shards_errors(self):
+
+        self.build_shards(2)
+        shutil.copytree('build-0', 'build-copy')
+
+        with self.assertRaises(ValueError):
+            merge_shards('build', ['build-0'])
+        with self.assertRaises(ValueError):
+            merge_shards('build', ['build-0', 'build-1', 'build-copy'])
+        self.assertFalse(os.path.exists('build'))
+
     # clear_output()
 
     def test_clear_output(self):
@@ -517,3 +2099,43 @@ class TestRucola(BaseTest):
     def test_clear_missing_output(self):
 
         self.assertFalse(self.example_app().clear_output())
+
+
+class TestBenchmarks(BaseTest):
+    """benchmarks"""
+
+    def test_generate_site(self):
+
+        paths = generate_site('.', files=50, depth=2, min_size=10,
+                              max_size=100, binary=0.5)
+
+        self.assertEqual(len(paths), 50)
+        self.assertEqual(paths, generate_site('other', files=50, depth=2,
+                                              min_size=10, max_size=100,
+                                              binary=0.5))
+        self.assertCountEqual([i.path for i in Rucola('.').files], paths)
+        for i in paths:
+            size = os.path.getsize(join(SOURCE_DIR, *i.split('/')))
+            self.assertTrue(10 <= size <= 100)
+
+    def test_compare(self):
+
+        old = {'load': 1.0, 'build': 2.0, 'find': 1.0}
+        new = {'load': 1.1, 'build': 3.0, 'get': 5.0}
+
+        self.assertListEqual(compare(old, new, 0.2), [('build', 2.0, 3.0)])
+        self.assertListEqual(compare(old, new, 0.5), [])
+
+    def test_measure_setup(self):
+
+        calls = []
+
+        def setup():
+            calls.append('setup')
+            time.sleep(0.05)
+            return len(calls)
+
+        t = measure(lambda x: calls.append(x), repeat=2, setup=setup)
+
+        self.assertListEqual(calls, ['setup', 1, 'setup', 3])
+        self.assertLess(t, 0.05)